@@ -12,10 +12,12 @@ with the expected matches in the annotation file.
 
 import argparse
 import collections
+import concurrent.futures
 import csv
 import math
-import portion
-import re
+import multiprocessing
+import numpy as np
+import pandas as pd
 import sys
 
 from abc import ABC, abstractmethod
@@ -24,6 +26,12 @@ from operator import itemgetter
 from fields import *
 from util import *
 
+try:
+    # optional dependency, the segment-level kernels are compiled if available
+    import numba
+except ImportError:
+    numba = None
+
 
 # constants
 THRESHOLD_SMALL = (1 - 0.07)
@@ -37,6 +45,29 @@ MAX_TEMPO_SMALL = math.floor(tempo_scale_to_per_cent(1 / THRESHOLD_SMALL))
 MIN_TEMPO_MEDIUM = math.ceil(tempo_scale_to_per_cent(THRESHOLD_MEDIUM))
 MAX_TEMPO_MEDIUM = math.floor(tempo_scale_to_per_cent(1 / THRESHOLD_MEDIUM))
 
+# fields of the annotations used for the tags
+TAG_FIELDS = [
+    FIELD_ANNOTATION_TEMPO,
+    FIELD_ANNOTATION_PITCH,
+    FIELD_ANNOTATION_ECHO_DELAY,
+    FIELD_ANNOTATION_HIGH_PASS,
+    FIELD_ANNOTATION_LOW_PASS,
+    FIELD_ANNOTATION_REVERB,
+    FIELD_ANNOTATION_NOISE_TYPE,
+    FIELD_ANNOTATION_NOISE_COLOR,
+    FIELD_ANNOTATION_NOISE_SNR,
+    FIELD_ANNOTATION_MERGE_PREV,
+    FIELD_ANNOTATION_MERGE_NEXT,
+    ]
+
+# fields of the segment ranges
+RANGE_FIELDS = [
+    FIELD_ANNOTATION_REFERENCE_BEGIN,
+    FIELD_ANNOTATION_REFERENCE_END,
+    FIELD_ANNOTATION_QUERY_BEGIN,
+    FIELD_ANNOTATION_QUERY_END,
+    ]
+
 
 def get_parser():
     """
@@ -53,46 +84,188 @@ def get_parser():
 
     parser.add_argument('--level', '-l', choices=['files', 'seconds', 'all'], default='all',
                         help='Level of evaluation: matching files, matching seconds, all levels')
+    parser.add_argument('--csv-engine', choices=['c', 'pyarrow'], default='c',
+                        help='CSV parser used for loading the files, pyarrow is faster for large files')
+    parser.add_argument('--processes', '-p', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of processes for the segment-level evaluation')
 
     return parser
 
 
-def load_annotations_or_matches(fn):
+class Segments:
+    """
+    Segments of one (query_id, reference_id) pair stored as a structure of arrays.
+    Indexing and iterating gives the rows of the segments.
+    """
+
+    def __init__(self, rows, ranges):
+        """
+        Parameters:
+            rows: list of dicts with the fields used for the tags, one for each segment
+            ranges: NumPy array with (reference_begin, reference_end, query_begin, query_end) for each segment,
+                    or None if the segment ranges are not available
+        """
+        self.rows = rows
+        self.ranges = ranges
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+
+# segments of a pair without any annotation or match
+NO_SEGMENTS = Segments([], np.empty((0, 4), dtype=np.int64))
+
+
+def read_csv_as_strings(fn, engine='c'):
+    """
+    Read the CSV file to a pandas DataFrame with all values as strings.
+
+    Parameters:
+        fn: file name
+        engine: CSV parser ('c' for the pandas parser, or 'pyarrow')
+
+    Returns:
+        DataFrame, or None if the file is empty
+    """
+    if engine == 'pyarrow':
+        # optional dependency
+        import pyarrow
+        import pyarrow.csv
+
+        # the column types must be given explicitly, otherwise e.g. IDs with leading zeros would be parsed as integers
+        with open(fn) as fr:
+            header = next(csv.reader(fr, delimiter=','), None)
+        if header is None:
+            return None
+
+        convert_options = pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in header})
+        return pyarrow.csv.read_csv(fn, convert_options=convert_options).to_pandas()
+
+    try:
+        return pd.read_csv(fn, delimiter=',', dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        return None
+
+
+def load_annotations_or_matches(fn, engine='c'):
     """
     Load annotations or matches from the file.
 
+    Only the fields used by the evaluators are kept, the segment ranges are converted to integers
+    if the file contains them.
+
+    Parameters:
+        fn: file name
+        engine: CSV parser ('c' for the pandas parser, or 'pyarrow')
+
     Returns:
-        dict mapping (query_id, reference_id) to the list of segments
+        dict mapping (query_id, reference_id) to the segments
     """
-    items = collections.defaultdict(list)
+    df = read_csv_as_strings(fn, engine)
+    if df is None:
+        return dict()
 
-    with open(fn) as fr:
-        reader = csv.DictReader(fr, delimiter=',')
-        for row in reader:
-            pair = (row[FIELD_ANNOTATION_QUERY_ID], row[FIELD_ANNOTATION_REFERENCE_ID])
-            items[pair].append(row)
+    pair_fields = [FIELD_ANNOTATION_QUERY_ID, FIELD_ANNOTATION_REFERENCE_ID]
+    tag_fields = [field for field in TAG_FIELDS if field in df.columns]
+
+    # convert the segment ranges at once
+    ranges = None
+    if all(field in df.columns for field in RANGE_FIELDS):
+        try:
+            ranges = df[RANGE_FIELDS].astype(np.int64).to_numpy()
+        except ValueError:
+            # segment ranges are not available, only the file-level evaluation is possible
+            pass
+
+    if tag_fields:
+        rows = df[tag_fields].to_dict('records')
+    else:
+        rows = [dict() for _ in range(len(df))]
+
+    # group the rows by the pairs, keeping their order
+    pairs = list(df[pair_fields].drop_duplicates().itertuples(index=False, name=None))
+    row_pair_indices = df.groupby(pair_fields, sort=False).ngroup().to_numpy()
+    order = np.argsort(row_pair_indices, kind='stable')
+    bounds = np.cumsum(np.bincount(row_pair_indices, minlength=len(pairs)))[:-1]
+
+    items = dict()
+    for pair, indices in zip(pairs, np.split(order, bounds)):
+        items[pair] = Segments([rows[i] for i in indices.tolist()], ranges[indices] if ranges is not None else None)
 
     return items
 
 
-def convert_segment_ranges(items):
+def have_segment_ranges(items):
     """
-    Convert segment range fields to integers.
+    Check that the segment ranges are available.
 
     Parameters:
-        items: dict mapping (query_id, reference_id) to the list of segments
+        items: dict mapping (query_id, reference_id) to the segments
     """
+    return all(items[key].ranges is not None for key in items)
 
-    if items and FIELD_INTERVAL_REFERENCE in next(iter(items)):
-        # already converted
-        return
 
-    for key in items:
-        for elem in items[key]:
-            elem[FIELD_INTERVAL_REFERENCE] = portion.closedopen(int(elem[FIELD_ANNOTATION_REFERENCE_BEGIN]),
-                                                                int(elem[FIELD_ANNOTATION_REFERENCE_END]))
-            elem[FIELD_INTERVAL_QUERY] = portion.closedopen(int(elem[FIELD_ANNOTATION_QUERY_BEGIN]),
-                                                            int(elem[FIELD_ANNOTATION_QUERY_END]))
+def get_segment_arrays(segments):
+    """
+    Get the half-open segment ranges as NumPy arrays.
+
+    Returns:
+        (reference begins, reference ends, query begins, query ends)
+    """
+    ranges = segments.ranges
+    return ranges[:, 0], ranges[:, 1], ranges[:, 2], ranges[:, 3]
+
+
+def get_segment_lengths(segment_arrays):
+    """
+    Get the lengths of the segments from the segment arrays.
+
+    Returns:
+        (reference lengths, query lengths)
+    """
+    reference_begins, reference_ends, query_begins, query_ends = segment_arrays
+    return np.clip(reference_ends - reference_begins, 0, None), np.clip(query_ends - query_begins, 0, None)
+
+
+def get_overlaps(annotation_arrays, match_arrays):
+    """
+    Get the pairwise overlaps of the annotated and matched segments from their segment arrays.
+
+    Returns:
+        (reference overlap begins, reference overlap ends, query overlap begins, query overlap ends),
+        each of them is an array with a row for each matched segment and a column for each annotated segment,
+        the overlap is empty if its end is not greater than its beginning
+    """
+    a_rb, a_re, a_qb, a_qe = annotation_arrays
+    m_rb, m_re, m_qb, m_qe = match_arrays
+
+    # if the bounding boxes of the segments do not overlap in the reference or in the query,
+    # all overlaps there are empty, and they are not calculated
+    if ranges_may_overlap(a_rb, a_re, m_rb, m_re):
+        reference_lo = np.maximum(a_rb[None, :], m_rb[:, None])
+        reference_hi = np.minimum(a_re[None, :], m_re[:, None])
+    else:
+        reference_lo = reference_hi = np.zeros((len(m_rb), len(a_rb)), dtype=np.int64)
+
+    if ranges_may_overlap(a_qb, a_qe, m_qb, m_qe):
+        query_lo = np.maximum(a_qb[None, :], m_qb[:, None])
+        query_hi = np.minimum(a_qe[None, :], m_qe[:, None])
+    else:
+        query_lo = query_hi = np.zeros((len(m_rb), len(a_rb)), dtype=np.int64)
+
+    return reference_lo, reference_hi, query_lo, query_hi
+
+
+def ranges_may_overlap(a_begins, a_ends, b_begins, b_ends):
+    """
+    Check if any of the half-open ranges A may overlap any of the ranges B by comparing their bounding boxes.
+    """
+    if not len(a_begins) or not len(b_begins):
+        return False
+    return a_begins.min() < b_ends.max() and b_begins.min() < a_ends.max()
 
 
 def calculate_f_score(recall, precision):
@@ -104,37 +277,142 @@ def calculate_f_score(recall, precision):
     return 10 * recall * precision / (9 * recall + precision) if recall + precision > 0 else 0
 
 
-def get_interval_length(interval):
+def round_towards_target(value, target):
     """
-    Get the length of the interval.
+    Round the value towards the target, element-wise for NumPy arrays.
     """
-    return sum([x.upper - x.lower for x in interval if not x.empty])
+    return np.where(target > value, np.ceil(value), np.floor(value)).astype(np.int64)
 
 
-def round_towards_target(value, target):
+def _union_length(los, his):
     """
-    Round the value towards the target.
+    Get the length of the union of the half-open intervals [lo, hi), compiled by Numba.
     """
-    if target > value:
-        return math.ceil(value)
-    else:
-        return math.floor(value)
+    length = 0
+    preceding_hi = np.iinfo(np.int64).min
+    for i in np.argsort(los):
+        lo = max(los[i], preceding_hi)
+        if his[i] > lo:
+            length += his[i] - lo
+        preceding_hi = max(preceding_hi, his[i])
+    return length
+
+
+def _round_towards_target(value, target):
+    """
+    Round the value towards the target, compiled by Numba.
+    """
+    return int(math.ceil(value)) if target > value else int(math.floor(value))
+
+
+def _evaluate_length_pair(a_rb, a_re, a_qb, a_qe, a_tempos, m_rb, m_re, m_qb, m_qe):
+    """
+    Evaluate the matched segments according to the annotated segments using the segment lengths,
+    compiled by Numba. It is equivalent to the NumPy code of LengthSegmentEvaluator._evaluate_pair().
+
+    Returns:
+        (tp, up, fp, fn)
+    """
+    num_a = len(a_rb)
+    num_m = len(m_rb)
+
+    reference_lo = np.empty((num_m, num_a), dtype=np.int64)
+    reference_hi = np.empty((num_m, num_a), dtype=np.int64)
+    query_lo = np.empty((num_m, num_a), dtype=np.int64)
+    query_hi = np.empty((num_m, num_a), dtype=np.int64)
+    for m in range(num_m):
+        for a in range(num_a):
+            reference_lo[m, a] = max(a_rb[a], m_rb[m])
+            reference_hi[m, a] = min(a_re[a], m_re[m])
+            query_lo[m, a] = max(a_qb[a], m_qb[m])
+            query_hi[m, a] = min(a_qe[a], m_qe[m])
+
+    los = np.empty(max(num_a, num_m), dtype=np.int64)
+    his = np.empty(max(num_a, num_m), dtype=np.int64)
+    query_los = np.empty(max(num_a, num_m), dtype=np.int64)
+    query_his = np.empty(max(num_a, num_m), dtype=np.int64)
+
+    # True Positives and False Negatives for each annotated segment
+
+    tp = 0
+    fn = 0
+    for a in range(num_a):
+        n = 0
+        for m in range(num_m):
+            if reference_hi[m, a] > reference_lo[m, a] and query_hi[m, a] > query_lo[m, a]:
+                los[n] = reference_lo[m, a]
+                his[n] = reference_hi[m, a]
+                query_los[n] = query_lo[m, a]
+                query_his[n] = query_hi[m, a]
+                n += 1
+        overlap_reference_length = _union_length(los[:n], his[:n])
+        overlap_query_length = _union_length(query_los[:n], query_his[:n])
+        reference_length = max(0, a_re[a] - a_rb[a])
+        query_length = max(0, a_qe[a] - a_qb[a])
+
+        tp += min(overlap_reference_length,
+                  _round_towards_target(overlap_query_length * a_tempos[a], reference_length))
+        fn += max(reference_length - overlap_reference_length,
+                  _round_towards_target((query_length - overlap_query_length) * a_tempos[a], 0))
+
+    # False Positives and Unknown Positives for each matched segment
+
+    up = 0
+    fp = 0
+    for m in range(num_m):
+        reference_length = max(0, m_re[m] - m_rb[m])
+        query_length = max(0, m_qe[m] - m_qb[m])
+        tempo = reference_length / query_length if query_length > 0 else 1.0
+
+        n = 0
+        n_query = 0
+        for a in range(num_a):
+            if query_hi[m, a] > query_lo[m, a]:
+                query_los[n_query] = query_lo[m, a]
+                query_his[n_query] = query_hi[m, a]
+                n_query += 1
+                tempo = a_tempos[a]
+                if reference_hi[m, a] > reference_lo[m, a]:
+                    los[n] = reference_lo[m, a]
+                    his[n] = reference_hi[m, a]
+                    n += 1
+        overlap_reference_length = _union_length(los[:n], his[:n])
+        overlap_query_only_length = _round_towards_target(
+            _union_length(query_los[:n_query], query_his[:n_query]) * tempo, reference_length)
+        overlap_length = max(overlap_reference_length, overlap_query_only_length)
+
+        up += abs(overlap_reference_length - overlap_query_only_length)
+        fp += max(max(0, reference_length - overlap_length),
+                  _round_towards_target(query_length * tempo, reference_length) - overlap_query_only_length)
+
+    return tp, up, fp, fn
+
+
+if numba is not None:
+    _union_length = numba.njit(cache=True)(_union_length)
+    _round_towards_target = numba.njit(cache=True)(_round_towards_target)
+    _evaluate_length_pair = numba.njit(cache=True)(_evaluate_length_pair)
 
 
 def get_item_as_int(d, key, default):
     """
     Get an item from the dictionary and convert it to integer.
-    If the item does not exist, return the default.
+    If the item does not exist or it is not an integer, return the default.
     """
-    value = d.get(key, default)
-    value = int(value) if isinstance(value, str) and re.match(r'^[+-]?\d+$', value) else default
-    return value
+    try:
+        return int(d.get(key, default))
+    except (TypeError, ValueError):
+        return default
 
 
 def get_tags_from_annotation(annotation):
     """
     Get the list of tags for distinguishing the sub-results.
+    The tags are cached in the annotation.
     """
+    if FIELD_TAGS in annotation:
+        return annotation[FIELD_TAGS]
+
     tags = []
 
     # tempo, pitch, and speed (= tempo & pitch at the same time)
@@ -206,6 +484,7 @@ def get_tags_from_annotation(annotation):
         merge_next = 'end'
     tags.append('merge_next:' + merge_next)
 
+    annotation[FIELD_TAGS] = tags
     return tags
 
 
@@ -229,11 +508,17 @@ class BaseResults(ABC):
         writer.writerow(['recall', 'precision', 'f_score', 'tp', 'up', 'fp', 'fn', 'query_id', 'reference_id', 'tags'])
 
     @abstractmethod
+    def get_row(self, query_id='', reference_id=''):
+        """
+        Get the results as a CSV row.
+        """
+        pass
+
     def write_row(self, writer, query_id='', reference_id=''):
         """
         Write the results to a CSV row.
         """
-        pass
+        writer.writerow(self.get_row(query_id, reference_id))
 
 
 class RecallPrecisionResults(BaseResults):
@@ -244,32 +529,47 @@ class RecallPrecisionResults(BaseResults):
     def __init__(self):
         super().__init__()
 
-        self._recalls = []  # list of recalls
-        self._precisions = []  # list of precisions
+        self._count = 0  # number of results
+        self._recall_sum = 0  # sum of recalls
+        self._precision_sum = 0  # sum of precisions
 
         self._tags = set()
+        self._sorted_tags = None  # cached sorted list of tags
 
     def add(self, recall, precision, tags=None):
         """
         Add the result.
         """
-        if tags is None:
-            tags = set()
+        self._count += 1
+        self._recall_sum += recall
+        self._precision_sum += precision
 
-        self._recalls.append(recall)
-        self._precisions.append(precision)
+        if tags:
+            self._tags.update(tags)
+            self._sorted_tags = None
 
-        self._tags.update(tags)
+    def merge(self, other):
+        """
+        Merge the results of the other result set, without its tags.
+        """
+        self._count += other._count
+        self._recall_sum += other._recall_sum
+        self._precision_sum += other._precision_sum
 
     def get(self):
         """
         Get the overall results.
         """
-        recall = sum(self._recalls) / len(self._recalls) if self._recalls else 0
-        precision = sum(self._precisions) / len(self._precisions) if self._precisions else 1
+        recall = self._recall_sum / self._count if self._count else 0
+        precision = self._precision_sum / self._count if self._count else 1
         f_score = calculate_f_score(recall, precision)
         return recall, precision, f_score
 
+    def _get_sorted_tags(self):
+        if self._sorted_tags is None:
+            self._sorted_tags = sorted(self._tags)
+        return self._sorted_tags
+
     def _format_tags(self, name):
         if self._tags:
             if name == '':
@@ -278,7 +578,7 @@ class RecallPrecisionResults(BaseResults):
                 separator = ' '
             else:
                 separator = '  '
-            return separator + ', '.join(sorted(self._tags))
+            return separator + ', '.join(self._get_sorted_tags())
 
         return ''
 
@@ -290,11 +590,11 @@ class RecallPrecisionResults(BaseResults):
         tags = self._format_tags(name)
         print(f'R {100 * recall:6.2f}  P {100 * precision:6.2f}  F {100 * f_score:6.2f}  {name}{tags}')
 
-    def write_row(self, writer, query_id='', reference_id=''):
+    def get_row(self, query_id='', reference_id=''):
         recall, precision, f_score = self.get()
-        tags = ','.join(sorted(self._tags))
-        writer.writerow([f'{100 * recall:0.2f}', f'{100 * precision:0.2f}', f'{100 * f_score:0.2f}',
-                         '', '', '', '', query_id, reference_id, tags])
+        tags = ','.join(self._get_sorted_tags())
+        return [f'{100 * recall:0.2f}', f'{100 * precision:0.2f}', f'{100 * f_score:0.2f}',
+                '', '', '', '', query_id, reference_id, tags]
 
 
 class PositivesNegativesResults(RecallPrecisionResults):
@@ -326,6 +626,17 @@ class PositivesNegativesResults(RecallPrecisionResults):
         self._fp += fp
         self._fn += fn
 
+    def merge(self, other):
+        """
+        Merge the results of the other result set, without its tags.
+        """
+        super().merge(other)
+
+        self._tp += other._tp
+        self._up += other._up
+        self._fp += other._fp
+        self._fn += other._fn
+
     def get(self):
         """
         Get the overall results.
@@ -342,11 +653,11 @@ class PositivesNegativesResults(RecallPrecisionResults):
         print(f'R {100 * recall:6.2f}  P {100 * precision:6.2f}  F {100 * f_score:6.2f}  '
               f'TP {tp:6}  UP {up:6}  FP {fp:6}  FN {fn:6}  {name}{tags}')
 
-    def write_row(self, writer, query_id='', reference_id=''):
+    def get_row(self, query_id='', reference_id=''):
         recall, precision, f_score, tp, up, fp, fn = self.get()
-        tags = ','.join(sorted(self._tags))
-        writer.writerow([f'{100 * recall:0.2f}', f'{100 * precision:0.2f}', f'{100 * f_score:0.2f}',
-                         tp, up, fp, fn, query_id, reference_id, tags])
+        tags = ','.join(self._get_sorted_tags())
+        return [f'{100 * recall:0.2f}', f'{100 * precision:0.2f}', f'{100 * f_score:0.2f}',
+                tp, up, fp, fn, query_id, reference_id, tags]
 
 
 class BaseEvaluator(ABC):
@@ -354,40 +665,77 @@ class BaseEvaluator(ABC):
     Abstract base results evaluator.
     """
 
-    def evaluate(self, annotations, matches):
+    def evaluate(self, annotations, matches, num_processes=1):
         """
         Evaluate the matches according to annotations.
 
         Parameters:
-            annotations: dict mapping (query_id, reference_id) to the list of annotated segments
-            matches: dict mapping (query_id, reference_id) to the list of matched segments
+            annotations: dict mapping (query_id, reference_id) to the annotated segments
+            matches: dict mapping (query_id, reference_id) to the matched segments
+            num_processes: number of processes evaluating the pairs in parallel
         """
 
-        for pair in matches:
-            if pair in annotations:
-                self._evaluate_pair(pair, annotations[pair], matches[pair])
-            else:
-                self._evaluate_pair(pair, [], matches[pair])
-        for pair in annotations:
-            if pair not in matches:
-                self._evaluate_pair(pair, annotations[pair], [])
+        pairs = list(matches) + [pair for pair in annotations if pair not in matches]
+        pair_annotations = [annotations.get(pair, NO_SEGMENTS) for pair in pairs]
+        pair_matches = [matches.get(pair, NO_SEGMENTS) for pair in pairs]
 
+        if num_processes > 1:
+            with concurrent.futures.ProcessPoolExecutor(num_processes) as executor:
+                results = list(executor.map(self._evaluate_pair, pair_annotations, pair_matches, chunksize=64))
+        else:
+            results = map(self._evaluate_pair, pair_annotations, pair_matches)
+
+        for pair, annotation, result in zip(pairs, pair_annotations, results):
+            self._store_results(pair, annotation, result)
+
+    @staticmethod
     @abstractmethod
-    def _evaluate_pair(self, pair, annotation, match):
+    def _evaluate_pair(annotation, match):
         """
         Evaluate the match according to the annotation.
 
         Parameters:
-            pair: (query_id, reference_id)
-            annotation: list of annotated segments
-            match: match list of matched segments
+            annotation: annotated segments
+            match: matched segments
+
+        Returns:
+            tuple with the results for the pair
         """
         pass
 
+    def _store_results(self, pair, annotation, result):
+        """
+        Store the results for the pair.
+
+        Parameters:
+            pair: (query_id, reference_id)
+            annotation: annotated segments
+            result: tuple with the results for the pair
+        """
+        self._pair_results[pair].add(*result, get_tags_from_annotation(annotation[0]) if annotation else [])
+        for a in range(len(annotation)):
+            for tag in get_tags_from_annotation(annotation[a]):
+                self._tag_results[tag].add(*result, {tag})
+        self._all_results.add(*result, {'TOTAL'})
+
+    def _get_ref_results(self):
+        """
+        Get the results for each reference by merging the results of its pairs.
+
+        Returns:
+            dict mapping reference_id to the results
+        """
+        ref_results = collections.defaultdict(type(self._all_results))
+        for pair, results in self._pair_results.items():
+            ref_results[pair[1]].merge(results)
+        return ref_results
+
     def output_results(self, title, fw=None):
         """
         Output the results with the title to stdout or CSV file.
         """
+        ref_results = self._get_ref_results()
+
         if not fw:
             # output to stdout
             print(title)
@@ -395,8 +743,8 @@ class BaseEvaluator(ABC):
             for pair in sorted(self._pair_results):
                 self._pair_results[pair].print(f'{pair[0]}  {pair[1]}')
 
-            for ref in sorted(self._ref_results):
-                self._ref_results[ref].print(f'REF {ref}')
+            for ref in sorted(ref_results):
+                ref_results[ref].print(f'REF {ref}')
 
             for tag in sorted(self._tag_results):
                 self._tag_results[tag].print(f'TAG')
@@ -410,14 +758,10 @@ class BaseEvaluator(ABC):
             writer = csv.writer(fw, delimiter=',', lineterminator='\n')
             self._all_results.write_header(writer)
 
-            for pair in sorted(self._pair_results):
-                self._pair_results[pair].write_row(writer, query_id=pair[0], reference_id=pair[1])
-
-            for ref in sorted(self._ref_results):
-                self._ref_results[ref].write_row(writer, reference_id=ref)
-
-            for tag in sorted(self._tag_results):
-                self._tag_results[tag].write_row(writer)
+            writer.writerows(self._pair_results[pair].get_row(query_id=pair[0], reference_id=pair[1])
+                             for pair in sorted(self._pair_results))
+            writer.writerows(ref_results[ref].get_row(reference_id=ref) for ref in sorted(ref_results))
+            writer.writerows(self._tag_results[tag].get_row() for tag in sorted(self._tag_results))
 
             self._all_results.write_row(writer)
             print(file=fw)
@@ -432,18 +776,20 @@ class TrackEvaluator(BaseEvaluator):
         super().__init__()
 
         self._pair_results = collections.defaultdict(PositivesNegativesResults)
-        self._ref_results = collections.defaultdict(PositivesNegativesResults)
         self._tag_results = collections.defaultdict(PositivesNegativesResults)
         self._all_results = PositivesNegativesResults()
 
-    def _evaluate_pair(self, pair, annotation, match):
+    @staticmethod
+    def _evaluate_pair(annotation, match):
         """
         Evaluate the match according to the annotation.
 
         Parameters:
-            pair: (query_id, reference_id)
-            annotation: list of annotated segments
-            match: match list of matched segments
+            annotation: annotated segments
+            match: matched segments
+
+        Returns:
+            (tp, up, fp, fn)
         """
         b_annotation = bool(annotation)
         b_match = bool(match)
@@ -453,14 +799,27 @@ class TrackEvaluator(BaseEvaluator):
         fp = int(not b_annotation and b_match)
         up = 0
 
-        # store the results
+        return tp, up, fp, fn
 
-        self._pair_results[pair].add(tp, up, fp, fn, get_tags_from_annotation(annotation[0]) if annotation else [])
-        self._ref_results[pair[1]].add(tp, up, fp, fn)
-        for a in range(len(annotation)):
-            for tag in get_tags_from_annotation(annotation[a]):
-                self._tag_results[tag].add(tp, up, fp, fn, {tag})
-        self._all_results.add(tp, up, fp, fn, {'TOTAL'})
+    def _store_results(self, pair, annotation, result):
+        """
+        Store the results for the pair.
+
+        Parameters:
+            pair: (query_id, reference_id)
+            annotation: annotated segments
+            result: (tp, up, fp, fn)
+        """
+        self._pair_results[pair].add(*result, get_tags_from_annotation(annotation[0]) if annotation else [])
+
+        # the file-level result is the same for all annotated segments, count it once per tag
+        unique_tags = set()
+        for a in annotation:
+            unique_tags.update(get_tags_from_annotation(a))
+        for tag in unique_tags:
+            self._tag_results[tag].add(*result, {tag})
+
+        self._all_results.add(*result, {'TOTAL'})
 
 
 class BoundingBoxSegmentEvaluator(BaseEvaluator):
@@ -472,44 +831,42 @@ class BoundingBoxSegmentEvaluator(BaseEvaluator):
         super().__init__()
 
         self._pair_results = collections.defaultdict(RecallPrecisionResults)
-        self._ref_results = collections.defaultdict(RecallPrecisionResults)
         self._tag_results = collections.defaultdict(RecallPrecisionResults)
         self._all_results = RecallPrecisionResults()
 
-    def _evaluate_pair(self, pair, annotation, match):
+    @staticmethod
+    def _evaluate_pair(annotation, match):
         """
         Evaluate the match according to the annotation.
 
         Parameters:
-            pair: (query_id, reference_id)
-            annotation: list of annotated segments
-            match: match list of matched segments
+            annotation: annotated segments
+            match: matched segments
+
+        Returns:
+            (recall, precision)
         """
 
-        overlaps = [[(a[FIELD_INTERVAL_REFERENCE] & m[FIELD_INTERVAL_REFERENCE],
-                      a[FIELD_INTERVAL_QUERY] & m[FIELD_INTERVAL_QUERY])
-                     for a in annotation]
-                    for m in match]
+        annotation_arrays = get_segment_arrays(annotation)
+        match_arrays = get_segment_arrays(match)
+        annotation_reference_lengths, annotation_query_lengths = get_segment_lengths(annotation_arrays)
+        match_reference_lengths, match_query_lengths = get_segment_lengths(match_arrays)
 
-        # calculate recall
+        reference_lo, reference_hi, query_lo, query_hi = get_overlaps(annotation_arrays, match_arrays)
+        overlap_mask = (reference_hi > reference_lo) & (query_hi > query_lo)
 
-        overlap_reference_length = 0
-        overlap_query_length = 0
+        # pairs without overlaps go straight to the zero-overlap result
+        # (the precision is 1 only for the matched segments of zero length, as below)
+        if not overlap_mask.any():
+            return 0, 1 if not match_reference_lengths.sum() and not match_query_lengths.sum() else 0
 
-        for a in range(len(annotation)):
-            overlap_reference_union = portion.empty()
-            overlap_query_union = portion.empty()
-
-            for m in range(len(match)):
-                if not overlaps[m][a][0].empty and not overlaps[m][a][1].empty:
-                    overlap_reference_union |= overlaps[m][a][0]
-                    overlap_query_union |= overlaps[m][a][1]
+        # calculate recall
 
-            overlap_reference_length += get_interval_length(overlap_reference_union)
-            overlap_query_length += get_interval_length(overlap_query_union)
+        overlap_reference_length = int(union_lengths(reference_lo.T, reference_hi.T, overlap_mask.T).sum())
+        overlap_query_length = int(union_lengths(query_lo.T, query_hi.T, overlap_mask.T).sum())
 
-        annotation_reference_length = sum([get_interval_length(x[FIELD_INTERVAL_REFERENCE]) for x in annotation])
-        annotation_query_length = sum([get_interval_length(x[FIELD_INTERVAL_QUERY]) for x in annotation])
+        annotation_reference_length = int(annotation_reference_lengths.sum())
+        annotation_query_length = int(annotation_query_lengths.sum())
 
         recall = 1
         recall *= overlap_reference_length / annotation_reference_length if annotation_reference_length else 0
@@ -517,36 +874,17 @@ class BoundingBoxSegmentEvaluator(BaseEvaluator):
 
         # calculate precision
 
-        overlap_reference_length = 0
-        overlap_query_length = 0
-
-        for m in range(len(match)):
-            overlap_reference_union = portion.empty()
-            overlap_query_union = portion.empty()
+        overlap_reference_length = int(union_lengths(reference_lo, reference_hi, overlap_mask).sum())
+        overlap_query_length = int(union_lengths(query_lo, query_hi, overlap_mask).sum())
 
-            for a in range(len(annotation)):
-                if not overlaps[m][a][0].empty and not overlaps[m][a][1].empty:
-                    overlap_reference_union |= overlaps[m][a][0]
-                    overlap_query_union |= overlaps[m][a][1]
-
-            overlap_reference_length += get_interval_length(overlap_reference_union)
-            overlap_query_length += get_interval_length(overlap_query_union)
-
-        match_reference_length = sum([get_interval_length(x[FIELD_INTERVAL_REFERENCE]) for x in match])
-        match_query_length = sum([get_interval_length(x[FIELD_INTERVAL_QUERY]) for x in match])
+        match_reference_length = int(match_reference_lengths.sum())
+        match_query_length = int(match_query_lengths.sum())
 
         precision = 1
         precision *= overlap_reference_length / match_reference_length if match_reference_length else 1
         precision *= overlap_query_length / match_query_length if match_query_length else 1
 
-        # store the results
-
-        self._pair_results[pair].add(recall, precision, get_tags_from_annotation(annotation[0]) if annotation else [])
-        self._ref_results[pair[1]].add(recall, precision)
-        for a in range(len(annotation)):
-            for tag in get_tags_from_annotation(annotation[a]):
-                self._tag_results[tag].add(recall, precision, {tag})
-        self._all_results.add(recall, precision, {'TOTAL'})
+        return recall, precision
 
 
 class LengthSegmentEvaluator(BaseEvaluator):
@@ -558,108 +896,89 @@ class LengthSegmentEvaluator(BaseEvaluator):
         super().__init__()
 
         self._pair_results = collections.defaultdict(PositivesNegativesResults)
-        self._ref_results = collections.defaultdict(PositivesNegativesResults)
         self._tag_results = collections.defaultdict(PositivesNegativesResults)
         self._all_results = PositivesNegativesResults()
 
-    def _evaluate_pair(self, pair, annotation, match):
+    @staticmethod
+    def _evaluate_pair(annotation, match):
         """
         Evaluate the match according to the annotation.
 
         Parameters:
-            pair: (query_id, reference_id)
-            annotation: list of annotated segments
-            match: match list of matched segments
-        """
-
-        overlaps = [[(a[FIELD_INTERVAL_REFERENCE] & m[FIELD_INTERVAL_REFERENCE],
-                      a[FIELD_INTERVAL_QUERY] & m[FIELD_INTERVAL_QUERY])
-                     for a in annotation]
-                    for m in match]
+            annotation: annotated segments
+            match: matched segments
 
-        # calculate True Positives and False Negatives
-
-        tp = 0  # True Positives
-        fn = 0  # False Negatives
+        Returns:
+            (tp, up, fp, fn)
+        """
 
-        for a in range(len(annotation)):
-            tempo = get_item_as_int(annotation[a], FIELD_ANNOTATION_TEMPO, 100) / 100
+        annotation_arrays = get_segment_arrays(annotation)
+        match_arrays = get_segment_arrays(match)
 
-            overlap_reference_union = portion.empty()
-            overlap_query_union = portion.empty()
+        # tempo of each annotated segment
+        annotation_tempos = np.array([get_item_as_int(x, FIELD_ANNOTATION_TEMPO, 100) for x in annotation],
+                                     dtype=np.int64) / 100
 
-            for m in range(len(match)):
-                if not overlaps[m][a][0].empty and not overlaps[m][a][1].empty:
-                    overlap_reference_union |= overlaps[m][a][0]
-                    overlap_query_union |= overlaps[m][a][1]
+        if numba is not None:
+            return _evaluate_length_pair(*annotation_arrays, annotation_tempos, *match_arrays)
 
-            annotation_reference_length = get_interval_length(annotation[a][FIELD_INTERVAL_REFERENCE])
-            overlap_reference_length = get_interval_length(overlap_reference_union)
-            overlap_query_length = round_towards_target(get_interval_length(overlap_query_union) * tempo,
-                                                        annotation_reference_length)
-            overlap_length = min(overlap_reference_length, overlap_query_length)
+        annotation_reference_lengths, annotation_query_lengths = get_segment_lengths(annotation_arrays)
+        match_reference_lengths, match_query_lengths = get_segment_lengths(match_arrays)
 
-            tp += overlap_length
+        reference_lo, reference_hi, query_lo, query_hi = get_overlaps(annotation_arrays, match_arrays)
+        overlap_mask = (reference_hi > reference_lo) & (query_hi > query_lo)
 
-            missing_reference_union = annotation[a][FIELD_INTERVAL_REFERENCE] - overlap_reference_union
-            missing_query_union = annotation[a][FIELD_INTERVAL_QUERY] - overlap_query_union
-            missing_reference_length = get_interval_length(missing_reference_union)
-            missing_query_length = round_towards_target(get_interval_length(missing_query_union) * tempo, 0)
-            missing_length = max(missing_reference_length, missing_query_length)
+        # calculate True Positives and False Negatives for each annotated segment
 
-            fn += missing_length
+        overlap_reference_lengths = union_lengths(reference_lo.T, reference_hi.T, overlap_mask.T)
+        overlap_query_lengths = union_lengths(query_lo.T, query_hi.T, overlap_mask.T)
 
-        # calculate False Positives and Unknown Positives
+        # True Positives = minimum of the overlaps in the reference and in the query
+        tp_lengths = np.minimum(overlap_reference_lengths,
+                                round_towards_target(overlap_query_lengths * annotation_tempos,
+                                                     annotation_reference_lengths))
 
-        up = 0  # Unknown Positives
-        fp = 0  # False Positives
+        # False Negatives = maximum of the annotated segment parts not covered by the overlaps,
+        # the overlaps are subsets of the annotated segment
+        fn_lengths = np.maximum(annotation_reference_lengths - overlap_reference_lengths,
+                                round_towards_target((annotation_query_lengths - overlap_query_lengths) *
+                                                     annotation_tempos, 0))
 
-        for m in range(len(match)):
-            overlap_reference_union = portion.empty()
-            overlap_query_only_union = portion.empty()
+        tp = int(tp_lengths.sum())  # True Positives
+        fn = int(fn_lengths.sum())  # False Negatives
 
-            match_reference_length = get_interval_length(match[m][FIELD_INTERVAL_REFERENCE])
-            match_query_length = get_interval_length(match[m][FIELD_INTERVAL_QUERY])
+        # calculate False Positives and Unknown Positives for each matched segment
 
-            # take the tempo from the match segment, for the case there will not be any overlapping reference segments
-            tempo = match_reference_length / match_query_length if match_query_length else 1
+        query_only_mask = query_hi > query_lo
 
-            for a in range(len(annotation)):
-                if overlaps[m][a][1]:
-                    # take the tempo from some (the last) annotation segment that overlaps the match segment
-                    tempo = get_item_as_int(annotation[a], FIELD_ANNOTATION_TEMPO, 100) / 100
-                if not overlaps[m][a][0].empty and not overlaps[m][a][1].empty:
-                    overlap_reference_union |= overlaps[m][a][0]
-                overlap_query_only_union |= overlaps[m][a][1]
+        # take the tempo from the match segment, for the case there will not be any overlapping reference segments
+        match_tempos = np.divide(match_reference_lengths, match_query_lengths,
+                                 out=np.ones(len(match)), where=match_query_lengths > 0)
+        if len(annotation):
+            # take the tempo from some (the last) annotation segment that overlaps the match segment
+            last_a = len(annotation) - 1 - np.argmax(query_only_mask[:, ::-1], axis=1)
+            match_tempos = np.where(query_only_mask.any(axis=1), annotation_tempos[last_a], match_tempos)
 
-            # True Positives + Unknown Positives = maximum of the full overlap in the reference and the partial overlap
-            # in the query only
-            overlap_reference_length = get_interval_length(overlap_reference_union)
-            overlap_query_only_length = round_towards_target(get_interval_length(overlap_query_only_union) * tempo,
-                                                             match_reference_length)
-            overlap_length = max(overlap_reference_length, overlap_query_only_length)
+        # True Positives + Unknown Positives = maximum of the full overlap in the reference and the partial overlap
+        # in the query only
+        overlap_reference_lengths = union_lengths(reference_lo, reference_hi, overlap_mask)
+        overlap_query_only_lengths = round_towards_target(
+            union_lengths(query_lo, query_hi, query_only_mask) * match_tempos, match_reference_lengths)
+        overlap_lengths = np.maximum(overlap_reference_lengths, overlap_query_only_lengths)
 
-            # Unknown Positives = absolute difference of the full overlap in the reference and the partial overlap
-            # in the query only
-            unknown_length = abs(overlap_reference_length - overlap_query_only_length)
+        # Unknown Positives = absolute difference of the full overlap in the reference and the partial overlap
+        # in the query only
+        up_lengths = np.abs(overlap_reference_lengths - overlap_query_only_lengths)
 
-            # False Positives = match - (True Positives + Unknown Positives)
-            surplus_reference_length = max(0, match_reference_length - overlap_length)
-            surplus_query_length = round_towards_target(match_query_length * tempo,
-                                                        match_reference_length) - overlap_query_only_length
-            surplus_length = max(surplus_reference_length, surplus_query_length)
+        # False Positives = match - (True Positives + Unknown Positives)
+        fp_lengths = np.maximum(np.maximum(0, match_reference_lengths - overlap_lengths),
+                                round_towards_target(match_query_lengths * match_tempos, match_reference_lengths) -
+                                overlap_query_only_lengths)
 
-            fp += surplus_length
-            up += unknown_length
+        up = int(up_lengths.sum())  # Unknown Positives
+        fp = int(fp_lengths.sum())  # False Positives
 
-        # store the results
-
-        self._pair_results[pair].add(tp, up, fp, fn, get_tags_from_annotation(annotation[0]) if annotation else [])
-        self._ref_results[pair[1]].add(tp, up, fp, fn)
-        for a in range(len(annotation)):
-            for tag in get_tags_from_annotation(annotation[a]):
-                self._tag_results[tag].add(tp, up, fp, fn, {tag})
-        self._all_results.add(tp, up, fp, fn, {'TOTAL'})
+        return tp, up, fp, fn
 
 
 def main():
@@ -668,8 +987,8 @@ def main():
     args = parser.parse_args()
 
     # load the data
-    annotations = load_annotations_or_matches(args.annotation_file)
-    matches = load_annotations_or_matches(args.matches_file)
+    annotations = load_annotations_or_matches(args.annotation_file, args.csv_engine)
+    matches = load_annotations_or_matches(args.matches_file, args.csv_engine)
 
     if args.output_csv_file:
         fw = open(args.output_csv_file, 'wt')
@@ -684,10 +1003,7 @@ def main():
 
     # run the segment-level evaluators
     if args.level in ['seconds', 'all']:
-        try:
-            convert_segment_ranges(matches)
-            convert_segment_ranges(annotations)
-        except:
+        if not have_segment_ranges(matches) or not have_segment_ranges(annotations):
             print(
                 'The matches or the annotations not contain segment ranges, '
                 'matching seconds evaluation is not possible!',
@@ -695,11 +1011,11 @@ def main():
             return
 
         evaluator = BoundingBoxSegmentEvaluator()
-        evaluator.evaluate(annotations, matches)
+        evaluator.evaluate(annotations, matches, args.processes)
         evaluator.output_results('Bounding Box Segment results', fw)
 
         evaluator = LengthSegmentEvaluator()
-        evaluator.evaluate(annotations, matches)
+        evaluator.evaluate(annotations, matches, args.processes)
         evaluator.output_results('Length Segment results', fw)
 
     if fw:
@@ -64,7 +64,6 @@ ANNOTATION_SORT_FIELDS = [
     ]
 
 FIELD_CHUNK_DURATION = 'duration'
-FIELD_CHUNK_FILE = 'file'
 FIELD_CHUNK_INDEX = 'index'
 FIELD_CHUNK_MERGE_NEXT = 'merge_next'
 FIELD_CHUNK_MERGE_NEXT_DURATION = 'merge_next_duration'
@@ -77,8 +76,7 @@ FIELD_CHUNK_TRACK = 'track'
 FIELD_CHUNK_MODIFICATION = 'modification'
 FIELD_CHUNK_NOISE = 'noise'
 
-FIELD_INTERVAL_REFERENCE = 'reference_interval'
-FIELD_INTERVAL_QUERY = 'query_interval'
+FIELD_TAGS = '_tags'
 
 FIELD_TRACK_DURATION = 'track_duration'
 FIELD_TRACK_FILE = 'track_file'
@@ -13,10 +13,20 @@ filtering-out the matching pairs from the input set of audios.
 import argparse
 import collections
 import csv
+import heapq
+import numpy as np
 import sys
 
+from operator import itemgetter
+
 from fields import *
 
+try:
+    # optional dependency, the greedy removal of the matching tracks is compiled if available
+    import numba
+except ImportError:
+    numba = None
+
 
 def get_parser():
     """
@@ -33,21 +43,57 @@ def get_parser():
 
 def load_track_list(fn):
     """
-    Load the track list from the file.
+    Load the track IDs from the track list file, the rows are not kept in memory.
 
     Returns:
-        dict mapping track ID to a CSV row
+        dict mapping track ID to the index of its (last) CSV row
     """
     tracks = dict()
 
     with open(fn, 'r') as fr:
-        reader = csv.DictReader(fr)
-        for row in reader:
-            tracks[row[FIELD_TRACK_ID]] = row
+        reader = csv.reader(fr)
+        header = next(reader, [])
+        if not header:
+            return tracks
+
+        # empty lines are skipped, as csv.DictReader does (the same rows are indexed in write_track_list)
+        track_id_column = header.index(FIELD_TRACK_ID)
+        for index, row in enumerate(row for row in reader if row):
+            tracks[row[track_id_column]] = index
 
     return tracks
 
 
+def write_track_list(input_fn, output_fn, tracks):
+    """
+    Write the rows of the tracks from the input track list file to the output file, sorted by track ID.
+
+    The rows are streamed from the input file, they are only sorted in memory if the input file is not sorted.
+
+    Parameters:
+        input_fn: file name of the input track list
+        output_fn: file name of the output track list
+        tracks: dict mapping track ID to the index of its CSV row in the input file
+    """
+    track_ids = sorted(tracks, key=tracks.get)
+    is_sorted = all(track_id < next_track_id for track_id, next_track_id in zip(track_ids, track_ids[1:]))
+
+    with open(input_fn, 'r') as fr, open(output_fn, 'wt') as fw:
+        reader = csv.reader(fr)
+        header = next(reader)
+        track_id_column = header.index(FIELD_TRACK_ID)
+
+        writer = csv.writer(fw, delimiter=',', lineterminator='\n')
+        writer.writerow(header)
+
+        rows = (row for index, row in enumerate(row for row in reader if row)
+                if tracks.get(row[track_id_column]) == index)
+        if is_sorted:
+            writer.writerows(rows)
+        else:
+            writer.writerows(sorted(rows, key=itemgetter(track_id_column)))
+
+
 def load_matches(fn):
     """
     Load the matches form the file.
@@ -57,29 +103,103 @@ def load_matches(fn):
         for each reference ID)
     """
     matches = collections.defaultdict(set)
-    counts = collections.Counter()
 
     with open(fn, 'r') as fr:
-        reader = csv.DictReader(fr)
-        for row in reader:
-            reference_id = row[FIELD_ANNOTATION_REFERENCE_ID]
-            query_id = row[FIELD_ANNOTATION_QUERY_ID]
-            matches[reference_id].add(query_id)
-            matches[query_id].add(reference_id)
-
-    for reference_id in matches:
-        counts[reference_id] = len(matches[reference_id])
+        reader = csv.reader(fr)
+        header = next(reader, [])
+        if header:
+            reference_id_column = header.index(FIELD_ANNOTATION_REFERENCE_ID)
+            query_id_column = header.index(FIELD_ANNOTATION_QUERY_ID)
+            for row in reader:
+                if not row:  # skip empty lines, as csv.DictReader does
+                    continue
+                reference_id = row[reference_id_column]
+                query_id = row[query_id_column]
+                matches[reference_id].add(query_id)
+                matches[query_id].add(reference_id)
+
+    counts = {reference_id: len(query_ids) for reference_id, query_ids in matches.items()}
 
     return matches, counts
 
 
+def _select_matching_tracks(offsets, neighbors, counts):
+    """
+    Select the tracks to remove by the greedy algorithm of remove_matches(), compiled by Numba.
+
+    Parameters:
+        offsets: offsets of the neighbors of each track in the neighbors array (CSR format)
+        neighbors: indices of the matching tracks of each track
+        counts: number of the matching tracks of each track
+
+    Returns:
+        boolean array, true for the tracks to remove
+    """
+    num_tracks = len(counts)
+    counts = counts.copy()
+    selected = np.zeros(num_tracks, dtype=np.bool_)
+    remaining = num_tracks
+
+    # priority queue of (-count, index), the entries with outdated counts are skipped when popped
+    queue = [(-counts[index], index) for index in range(num_tracks)]
+    heapq.heapify(queue)
+
+    while remaining:
+        count, index = heapq.heappop(queue)
+        if counts[index] != -count:
+            continue
+
+        # remove the selected track from its matches
+        for neighbor in neighbors[offsets[index]:offsets[index + 1]]:
+            if counts[neighbor] > 0:
+                counts[neighbor] -= 1
+                if counts[neighbor] == 0:
+                    remaining -= 1
+                else:
+                    heapq.heappush(queue, (-counts[neighbor], neighbor))
+
+        # remove the selected track
+        selected[index] = True
+        counts[index] = 0
+        remaining -= 1
+
+    return selected
+
+
+if numba is not None:
+    _select_matching_tracks = numba.njit(cache=True)(_select_matching_tracks)
+
+
 def remove_matches(tracks, matches, counts):
     """
     Remove the matching tracks from the track list.
     """
+    if numba is not None:
+        if counts:
+            # the tracks are indexed in the order of the counts, which keeps the tie-break of the heap below
+            track_ids = list(counts)
+            indices = {track_id: index for index, track_id in enumerate(track_ids)}
+            index_counts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+            offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(index_counts, out=offsets[1:])
+            neighbors = np.fromiter((indices[query_id] for track_id in track_ids for query_id in matches[track_id]),
+                                    dtype=np.int64, count=offsets[-1])
+
+            for index in np.flatnonzero(_select_matching_tracks(offsets, neighbors, index_counts)):
+                del tracks[track_ids[index]]
+        return
+
+    # priority queue of (-count, index, track ID), the index keeps the tracks with the same count
+    # in their original order, the entries with outdated counts are skipped when popped
+    indices = {reference_id: index for index, reference_id in enumerate(counts)}
+    queue = [(-count, indices[reference_id], reference_id) for reference_id, count in counts.items()]
+    heapq.heapify(queue)
+
     while counts:
         # select the track with the most matches
-        reference_id, count = counts.most_common(1)[0]
+        count, _, reference_id = heapq.heappop(queue)
+        if counts.get(reference_id) != -count:
+            continue
 
         # remove the selected track from its matches
         for query_id in matches[reference_id]:
@@ -88,6 +208,8 @@ def remove_matches(tracks, matches, counts):
             if not matches[query_id]:
                 del matches[query_id]
                 del counts[query_id]
+            else:
+                heapq.heappush(queue, (-counts[query_id], indices[query_id], query_id))
 
         # remove the selected track
         del tracks[reference_id]
@@ -108,12 +230,7 @@ def main():
 
     # write the output file
     if tracks:
-        with open(args.output, 'wt') as fw:
-            fields = list(tracks[next(iter(tracks))].keys())
-            writer = csv.DictWriter(fw, fields, delimiter=',', lineterminator='\n')
-            writer.writeheader()
-            for _, row in sorted(tracks.items()):
-                writer.writerow(row)
+        write_track_list(args.input, args.output, tracks)
     else:
         print('No suitable input tracks exist!', file=sys.stderr)
         sys.exit(1)
@@ -10,17 +10,15 @@ Generator of the query audio files from the reference audio files.
 """
 
 import argparse
+import bisect
+import concurrent.futures
 import csv
-import functools
-import glob
 import math
 import multiprocessing
 import os
-import queue
 import random
 import subprocess
 import sys
-import threading
 
 from operator import itemgetter
 
@@ -39,8 +37,8 @@ def get_parser():
                         help='Output file with annotations for generated queries')
     parser.add_argument('--query-dir', '-q', default='queries',
                         help='Directory for generated queries')
-    parser.add_argument('--tmp-dir', '-t', default='tmp',
-                        help='Directory for temporary files')
+    parser.add_argument('--tmp-dir', '-t',
+                        help='Deprecated and ignored, the queries are created without temporary files')
     parser.add_argument('--threads', '-T', type=int, default=multiprocessing.cpu_count(),
                         help='Number of threads')
 
@@ -64,20 +62,99 @@ def initialize(args):
     Initialize for generating the queries.
     """
     os.makedirs(args.query_dir, exist_ok=True)
-    os.makedirs(args.tmp_dir, exist_ok=True)
 
 
-def cleanup(args):
+def get_noise_samples(noise_dir):
     """
-    Cleanup after generating the queries.
+    Get the paths of the noise sample files (*.wav) in the directory, in the directory order like glob.
     """
-    for fn in glob.glob(os.path.join(args.tmp_dir, 'chunk_*_*.*')):
-        os.remove(fn)
-
     try:
-        os.rmdir(args.tmp_dir)
-    except:
-        pass
+        with os.scandir(noise_dir) as entries:
+            return [entry.path for entry in entries if entry.name.endswith('.wav') and not entry.name.startswith('.')]
+    except FileNotFoundError:
+        return []
+
+
+def sort_annotation_file(fn):
+    """
+    Sort the rows of the annotation file by ANNOTATION_SORT_FIELDS, the segment ranges are compared as integers.
+    """
+    with open(fn, 'r') as fr:
+        reader = csv.reader(fr)
+        header = next(reader)
+        rows = list(reader)
+
+    columns = [header.index(field) for field in ANNOTATION_SORT_FIELDS]
+    integer_columns = [header.index(field) for field in ANNOTATION_SORT_FIELDS
+                       if field not in (FIELD_ANNOTATION_QUERY_ID, FIELD_ANNOTATION_REFERENCE_ID)]
+    rows.sort(key=lambda row: tuple(int(row[c]) if c in integer_columns else row[c] for c in columns))
+
+    with open(fn, 'w') as fw:
+        writer = csv.writer(fw, delimiter=',', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def get_echo_filter(modification):
+    """
+    Get the FFmpeg filter for the echo modification.
+    """
+    delay = modification[FIELD_MODIFICATION_ECHO_DELAY]
+    decay = modification[FIELD_MODIFICATION_ECHO_DECAY]
+    out_gain = round(1.0 / (0.8 + decay), 2)
+    return f'aecho=0.8:{out_gain:0.2f}:{delay}:{decay:0.1f}'
+
+
+def get_high_pass_filter(modification):
+    """
+    Get the FFmpeg filter for the high-pass modification.
+    """
+    return f'highpass=f={modification[FIELD_MODIFICATION_HIGH_PASS]}'
+
+
+def get_low_pass_filter(modification):
+    """
+    Get the FFmpeg filter for the low-pass modification.
+    """
+    return f'lowpass=f={modification[FIELD_MODIFICATION_LOW_PASS]}'
+
+
+def get_tempo_pitch_filter(modification):
+    """
+    Get the FFmpeg filter for the pitch and/or tempo modification.
+    """
+    audio_filter = 'rubberband=channels=together'
+    if FIELD_MODIFICATION_PITCH in modification:
+        audio_filter += f':pitch={modification[FIELD_MODIFICATION_PITCH]}'
+    if FIELD_MODIFICATION_TEMPO in modification:
+        audio_filter += f':tempo={modification[FIELD_MODIFICATION_TEMPO]}'
+    return audio_filter
+
+
+def get_reverb_filter(modification):
+    """
+    Get the FFmpeg filter for the reverb modification.
+    """
+    return 'ladspa=file=tap_reverb:tap_reverb'
+
+
+# square of the minimum chunk duration (4.5 seconds), rounded up
+MIN_CHUNK_DURATION_SQR = math.ceil(4.5 * 4.5)
+
+# indices of the annotation fields in the annotation rows
+ANNOTATION_FIELD_INDICES = {field: index for index, field in enumerate(ANNOTATION_FIELDS)}
+ANNOTATION_SORT_KEY = itemgetter(*[ANNOTATION_FIELD_INDICES[field] for field in ANNOTATION_SORT_FIELDS])
+
+# FFmpeg filters for the modification names
+MODIFICATION_FILTERS = {
+    MODIFICATION_NAME_ECHO: get_echo_filter,
+    MODIFICATION_NAME_HIGH_PASS: get_high_pass_filter,
+    MODIFICATION_NAME_LOW_PASS: get_low_pass_filter,
+    MODIFICATION_NAME_PITCH: get_tempo_pitch_filter,
+    MODIFICATION_NAME_TEMPO: get_tempo_pitch_filter,
+    MODIFICATION_NAME_TEMPO_PITCH: get_tempo_pitch_filter,
+    MODIFICATION_NAME_REVERB: get_reverb_filter,
+    }
 
 
 class QueryGenerator:
@@ -85,58 +162,47 @@ class QueryGenerator:
     Generator of query files.
     """
 
-    def __init__(self, query_dir, tmp_dir, num_threads):
+    def __init__(self, query_dir, num_threads):
         """
         Parameters:
             query_dir: Directory for generated queries
-            tmp_dir: Directory for temporary files
             num_threads: Number of threads
         """
         self._query_dir = query_dir
-        self._tmp_dir = tmp_dir
         self._num_threads = num_threads
 
         self._tracks = dict()
-        self._annotations = []
+        self._sorted_track_ids = None  # cached sorted list of track IDs
+        # the annotations are written to the file as they are generated
+        self._annotation_file = None
+        self._annotation_fw = None
+        self._annotation_writer = None
+        self._last_query_id = None
+        self._annotations_sorted = True
 
-        self._error_in_thread = None
-        self._queue = None
-        self._threads = []
+        self._executor = None
 
-        self._noise_samples = glob.glob('noise/*.wav')
+        self._noise_samples = get_noise_samples('noise')
+
+        # noise types to choose from, half of the chunks are without noise
+        self._noise_choices = [NOISE_TYPE_CONTINUOUS, NOISE_TYPE_PULSATING] + \
+                              [NOISE_TYPE_SAMPLE] * len(self._noise_samples)
+        self._noise_choices += [None] * len(self._noise_choices)
+        self._noise_colors = [NOISE_COLOR_BROWN, NOISE_COLOR_PINK, NOISE_COLOR_WHITE]
 
     def create_threads(self):
         """
-        Create worker threads.
+        Create the pool of worker threads.
         """
-        self._queue = queue.Queue()
-        self._threads = [threading.Thread(target=self.__worker) for _ in range(self._num_threads)]
-        for thread in self._threads:
-            thread.start()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads)
 
     def join_threads(self):
         """
         Join the worker threads.
         """
-        if self._threads:
-            for _ in self._threads:
-                self._queue.put(None)
-            for thread in self._threads:
-                thread.join()
-
-            self._queue = None
-            self._threads = []
-
-    def __worker(self):
-        """
-        Thread worker method processing the tasks.
-        """
-        for task in iter(self._queue.get, None):
-            try:
-                task()
-            except BaseException as e:
-                self._error_in_thread = e
-            self._queue.task_done()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
     def _init_difficulty(self, difficulty):
         self._merge_choices = []
@@ -237,11 +303,7 @@ class QueryGenerator:
         """
         Get a random noise together with its parameters, or None.
         """
-        noise_choices = [NOISE_TYPE_CONTINUOUS, NOISE_TYPE_PULSATING] + \
-                        [NOISE_TYPE_SAMPLE] * len(self._noise_samples)
-        noise_choices += [None] * len(noise_choices)
-
-        typ = random.choice(noise_choices)
+        typ = random.choice(self._noise_choices)
         if not typ:
             return None
 
@@ -255,9 +317,7 @@ class QueryGenerator:
                      FIELD_NOISE_TYPE: typ,
                      }
         else:
-            color = random.choice([NOISE_COLOR_BROWN,
-                                   NOISE_COLOR_PINK,
-                                   NOISE_COLOR_WHITE])
+            color = random.choice(self._noise_colors)
             seed = random.randint(0, 0xffffffff)
 
             noise = {FIELD_NOISE_COLOR: color,
@@ -268,51 +328,27 @@ class QueryGenerator:
 
         return noise
 
-    def _create_chunk(self, chunk, codec, sample_rate, query_index):
-        """
-        Create a (modified) chunk from the track.
+    @staticmethod
+    def _get_chunk_filter(chunk, chunk_input, noise_input, sample_rate):
         """
-        # basic arguments with cutting out the chunk
-        args = ['ffmpeg', '-vn',
-                '-ss', '%0.1f' % (chunk[FIELD_CHUNK_POSITION]),
-                '-t', '%0.1f' % (chunk[FIELD_CHUNK_DURATION]),
-                '-i', chunk[FIELD_CHUNK_TRACK][FIELD_TRACK_FILE],
-                ]
+        Get the filtergraph creating the (modified) chunk from the cut-out part of the track.
 
-        audio_filter = 'loudnorm'
+        Parameters:
+            chunk: description of the chunk
+            chunk_input: index of the ffmpeg input with the cut-out part of the track
+            noise_input: index of the ffmpeg input with the noise sample (if any)
+            sample_rate: audio sample rate
+
+        Returns:
+            filtergraph with the output labeled [c<chunk index>]
+        """
+        chunk_index = chunk[FIELD_CHUNK_INDEX]
+        parts = [f'[{chunk_input}:a]loudnorm']
 
         # add modifications
         if chunk[FIELD_CHUNK_MODIFICATION]:
             modification = chunk[FIELD_CHUNK_MODIFICATION]
-
-            # echo
-            if modification[FIELD_MODIFICATION_NAME] == MODIFICATION_NAME_ECHO:
-                delay = modification[FIELD_MODIFICATION_ECHO_DELAY]
-                decay = modification[FIELD_MODIFICATION_ECHO_DECAY]
-                out_gain = round(1.0 / (0.8 + decay), 2)
-                audio_filter += f',aecho=0.8:{out_gain:0.2f}:{delay}:{decay:0.1f}'
-
-            # high-pass
-            elif modification[FIELD_MODIFICATION_NAME] == MODIFICATION_NAME_HIGH_PASS:
-                freq = modification[FIELD_MODIFICATION_HIGH_PASS]
-                audio_filter += f',highpass=f={freq}'
-
-            # low-pass
-            elif modification[FIELD_MODIFICATION_NAME] == MODIFICATION_NAME_LOW_PASS:
-                freq = modification[FIELD_MODIFICATION_LOW_PASS]
-                audio_filter += f',lowpass=f={freq}'
-
-            # pitch and/or tempo
-            elif FIELD_MODIFICATION_PITCH in modification or FIELD_MODIFICATION_TEMPO in modification:
-                audio_filter += ',rubberband=channels=together'
-                if FIELD_MODIFICATION_PITCH in modification:
-                    audio_filter += f':pitch={modification[FIELD_MODIFICATION_PITCH]}'
-                if FIELD_MODIFICATION_TEMPO in modification:
-                    audio_filter += f':tempo={modification[FIELD_MODIFICATION_TEMPO]}'
-
-            # reverb
-            elif modification[FIELD_MODIFICATION_NAME] == MODIFICATION_NAME_REVERB:
-                audio_filter += ',ladspa=file=tap_reverb:tap_reverb'
+            parts.append(',' + MODIFICATION_FILTERS[modification[FIELD_MODIFICATION_NAME]](modification))
 
         # add noise
         if chunk[FIELD_CHUNK_NOISE]:
@@ -321,55 +357,60 @@ class QueryGenerator:
             volume = -noise[FIELD_NOISE_SNR]
 
             if typ == NOISE_TYPE_SAMPLE:
-                args += ['-i', noise[FIELD_NOISE_FILE]]
-                audio_filter += f'[a];loudnorm'
+                parts.append(f'[a{chunk_index}];[{noise_input}:a]loudnorm')
                 if volume != 0:
-                    audio_filter += f',volume=volume={volume}dB'
-                audio_filter += '[n];[a][n]amix=duration=first'
+                    parts.append(f',volume=volume={volume}dB')
+                parts.append(f'[n{chunk_index}];[a{chunk_index}][n{chunk_index}]amix=duration=first')
 
             else:
                 color = noise[FIELD_NOISE_COLOR]
                 seed = noise[FIELD_NOISE_SEED]
                 duration = chunk[FIELD_CHUNK_DURATION] / chunk[FIELD_CHUNK_TEMPO]
 
-                audio_filter += f'[a];anoisesrc=r={sample_rate}:d={duration:0.2f}:c={color}:s={seed},loudnorm'
+                parts.append(f'[a{chunk_index}];')
+                parts.append(f'anoisesrc=r={sample_rate}:d={duration:0.2f}:c={color}:s={seed},loudnorm')
                 if volume != 0:
-                    audio_filter += f',volume=volume={volume}dB'
+                    parts.append(f',volume=volume={volume}dB')
                 if noise[FIELD_NOISE_TYPE] == NOISE_TYPE_PULSATING:
-                    audio_filter += f',apulsator=mode=square:offset_l=0.5:offset_r=0.5:hz=0.5:amount=1'
-                audio_filter += f'[n];[a][n]amix'
+                    parts.append(f',apulsator=mode=square:offset_l=0.5:offset_r=0.5:hz=0.5:amount=1')
+                parts.append(f'[n{chunk_index}];[a{chunk_index}][n{chunk_index}]amix')
 
-        args += ['-filter_complex', audio_filter]
-        args += ['-ar', str(sample_rate)]
-        args += ['-ac', '2']
-
-        if codec == 'mp3':
-            # do not write ID3 and Xing tags
-            args += ['-write_xing', '0', '-id3v2_version', '0']
+        # the chunks must have the same format to be merged, and they are padded and trimmed to their expected
+        # duration (e.g. the filters could make them shorter, the echo would make them longer),
+        # so that the annotations are exact
+        query_duration = chunk[FIELD_CHUNK_QUERY_DURATION]
+        parts.append(f',aformat=sample_rates={sample_rate}:channel_layouts=stereo')
+        parts.append(f',apad=whole_dur={query_duration:0.3f},atrim=duration={query_duration:0.3f}[c{chunk_index}]')
 
-        # add output file
-        chunk_file = os.path.join(self._tmp_dir, 'chunk_%04d_%04d.%s' % (query_index, chunk[FIELD_CHUNK_INDEX], codec))
-        chunk[FIELD_CHUNK_FILE] = chunk_file
-        args.extend(['-y', chunk_file])
-
-        # run ffmpeg to create the chunk
-        p = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if p.returncode != 0:
-            raise RuntimeError('ffmpeg failed!\nCOMMAND: "%s"\nSTDOUT:\n%s\nSTDERR:\n%s\n' % (
-                '" "'.join(args), p.stdout.decode(), p.stderr.decode()))
-
-        # update the chunk duration according to the real duration of the chunk file
-        duration = get_track_duration(chunk[FIELD_CHUNK_FILE])
-        if duration:
-            chunk[FIELD_CHUNK_QUERY_DURATION] = duration
+        return ''.join(parts)
 
     def _create_query(self, query_id, chunks, codec, sample_rate):
         """
-        Create the query from the chunks.
+        Create the query from the chunks by a single ffmpeg run, without intermediate chunk files.
         """
-        filter_complex = ''
+        args = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-vn']
+        filters = []
+
+        # cut out the chunks from the tracks and prepare their filters
+        num_inputs = 0
+        for chunk in chunks:
+            args += ['-ss', '%0.1f' % (chunk[FIELD_CHUNK_POSITION]),
+                     '-t', '%0.1f' % (chunk[FIELD_CHUNK_DURATION]),
+                     '-i', chunk[FIELD_CHUNK_TRACK][FIELD_TRACK_FILE],
+                     ]
+            chunk_input = num_inputs
+            num_inputs += 1
+
+            noise_input = None
+            if chunk[FIELD_CHUNK_NOISE] and chunk[FIELD_CHUNK_NOISE][FIELD_NOISE_TYPE] == NOISE_TYPE_SAMPLE:
+                args += ['-i', chunk[FIELD_CHUNK_NOISE][FIELD_NOISE_FILE]]
+                noise_input = num_inputs
+                num_inputs += 1
+
+            filters.append(self._get_chunk_filter(chunk, chunk_input, noise_input, sample_rate))
 
         # prepare the complex filter to merge different chunks using different merge types
+        merge_parts = ['[c0]' if len(chunks) > 1 else '[c0]anull']
         for chunk_index in range(len(chunks) - 1):
             chunk = chunks[chunk_index]
             if chunk[FIELD_CHUNK_MERGE_NEXT] == MERGE_NAME_CONCAT:
@@ -387,21 +428,19 @@ class QueryGenerator:
             else:
                 raise RuntimeError(f'Invalid merge: {chunk[FIELD_CHUNK_MERGE_NEXT]}')
 
-            if chunk_index == 0:
-                filter_complex += '[0]'
-            else:
-                filter_complex += f'[{chunk_index}m];[{chunk_index}m]'
-            filter_complex += f'[{chunk_index + 1}]acrossfade=d={duration}:o={overlap}:c1={merge_type}:c2={merge_type}'
-
-        # prepare the command-line arguments
-        args = ['ffmpeg', '-vn']
-        for chunk in chunks:
-            args += ['-i', chunk[FIELD_CHUNK_FILE]]
+            if chunk_index > 0:
+                merge_parts.append(f'[m{chunk_index}];[m{chunk_index}]')
+            merge_parts.append(f'[c{chunk_index + 1}]')
+            merge_parts.append(f'acrossfade=d={duration}:o={overlap}:c1={merge_type}:c2={merge_type}')
+        filters.append(''.join(merge_parts))
 
-        args += ['-filter_complex', filter_complex]
+        args += ['-filter_complex', ';'.join(filters)]
         args += ['-ar', str(sample_rate)]
         args += ['-ac', '2']
 
+        # do not write any metadata, for any codec
+        args += ['-map_metadata', '-1', '-fflags', '+bitexact']
+
         if codec == 'mp3':
             # do not write ID3 and Xing tags
             args += ['-write_xing', '0', '-id3v2_version', '0']
@@ -409,68 +448,89 @@ class QueryGenerator:
         query_file = os.path.join(self._query_dir, f'{query_id}.{codec}')
         args += ['-y', query_file]
 
-        # run ffmpeg to create the chunk
-        p = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # run ffmpeg to create the query
+        p = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         if p.returncode != 0:
-            raise RuntimeError('ffmpeg failed!\nCOMMAND: "%s"\nSTDOUT:\n%s\nSTDERR:\n%s\n' % (
-                '" "'.join(args), p.stdout.decode(), p.stderr.decode()))
-
-        for chunk in chunks:
-            os.remove(chunk[FIELD_CHUNK_FILE])
+            raise RuntimeError('ffmpeg failed!\nCOMMAND: "%s"\nSTDERR:\n%s\n' % ('" "'.join(args), p.stderr.decode()))
 
     def _add_query_annotations(self, query_id, chunks):
         """
         Add the annotations for the chunks of the query.
         """
+        rows = []
         query_begin = 0
         for chunk in chunks:
             reference_begin = chunk[FIELD_CHUNK_POSITION]
             reference_end = reference_begin + chunk[FIELD_CHUNK_DURATION]
             query_end = query_begin + chunk[FIELD_CHUNK_QUERY_DURATION]
 
-            annotation = {
-                FIELD_ANNOTATION_REFERENCE_ID: chunk[FIELD_CHUNK_TRACK][FIELD_TRACK_ID],
-                FIELD_ANNOTATION_QUERY_ID: query_id,
-                FIELD_ANNOTATION_REFERENCE_BEGIN: int(math.floor(reference_begin)),
-                FIELD_ANNOTATION_REFERENCE_END: int(math.ceil(reference_end)),
-                FIELD_ANNOTATION_QUERY_BEGIN: int(math.floor(query_begin)),
-                FIELD_ANNOTATION_QUERY_END: int(math.ceil(query_end)),
-            }
+            row = [''] * len(ANNOTATION_FIELDS)
             modification = chunk.get(FIELD_CHUNK_MODIFICATION)
             noise = chunk.get(FIELD_CHUNK_NOISE)
-            for field in ANNOTATION_FIELDS:
-                if field not in annotation:
-                    if field in chunk:
-                        if field == FIELD_ANNOTATION_TEMPO:
-                            annotation[field] = round(tempo_scale_to_per_cent(chunk[field]))
-                        else:
-                            annotation[field] = chunk[field]
-                    elif modification and field in modification:
-                        if field == FIELD_ANNOTATION_PITCH:
-                            annotation[field] = round(pitch_scale_to_cents(modification[field]))
-                        else:
-                            annotation[field] = modification[field]
-                    elif noise and field in noise:
-                        if field == FIELD_ANNOTATION_NOISE_FILE:
-                            annotation[field] = os.path.basename(noise[field])
-                        else:
-                            annotation[field] = noise[field]
-
-            self._annotations.append(annotation)
+            for index, field in enumerate(ANNOTATION_FIELDS):
+                if field in chunk:
+                    if field == FIELD_ANNOTATION_TEMPO:
+                        row[index] = round(tempo_scale_to_per_cent(chunk[field]))
+                    else:
+                        row[index] = chunk[field]
+                elif modification and field in modification:
+                    if field == FIELD_ANNOTATION_PITCH:
+                        row[index] = round(pitch_scale_to_cents(modification[field]))
+                    else:
+                        row[index] = modification[field]
+                elif noise and field in noise:
+                    if field == FIELD_ANNOTATION_NOISE_FILE:
+                        row[index] = os.path.basename(noise[field])
+                    else:
+                        row[index] = noise[field]
+
+            row[ANNOTATION_FIELD_INDICES[FIELD_ANNOTATION_REFERENCE_ID]] = chunk[FIELD_CHUNK_TRACK][FIELD_TRACK_ID]
+            row[ANNOTATION_FIELD_INDICES[FIELD_ANNOTATION_QUERY_ID]] = query_id
+            row[ANNOTATION_FIELD_INDICES[FIELD_ANNOTATION_REFERENCE_BEGIN]] = int(math.floor(reference_begin))
+            row[ANNOTATION_FIELD_INDICES[FIELD_ANNOTATION_REFERENCE_END]] = int(math.ceil(reference_end))
+            row[ANNOTATION_FIELD_INDICES[FIELD_ANNOTATION_QUERY_BEGIN]] = int(math.floor(query_begin))
+            row[ANNOTATION_FIELD_INDICES[FIELD_ANNOTATION_QUERY_END]] = int(math.ceil(query_end))
+
+            rows.append(tuple(row))
 
             merge_duration = chunk.get(FIELD_CHUNK_MERGE_NEXT_DURATION, 0)
             query_begin = query_end - merge_duration
 
+        # the query IDs are generated in the sorted order (up to 10000 queries), so sorting the annotations
+        # of each query is enough
+        if self._last_query_id is not None and query_id < self._last_query_id:
+            self._annotations_sorted = False
+        self._last_query_id = query_id
+
+        self._annotation_writer.writerows(sorted(rows, key=ANNOTATION_SORT_KEY))
+
     def load_track_list(self, fn):
         """
         Load the track list from the file.
         """
         with open(fn, 'r') as fr:
-            reader = csv.DictReader(fr)
+            reader = csv.reader(fr)
+            header = next(reader, [])
+            if not header:
+                return
+
+            self._sorted_track_ids = None
+
+            track_id_column = header.index(FIELD_TRACK_ID)
+            track_duration_column = header.index(FIELD_TRACK_DURATION)
+            # the track files are not needed for a dry run, so the track list does not have to contain them
+            track_file_column = header.index(FIELD_TRACK_FILE) if FIELD_TRACK_FILE in header else None
             for row in reader:
-                row[FIELD_TRACK_DURATION] = float(row[FIELD_TRACK_DURATION])
-                if row[FIELD_TRACK_DURATION] >= 10:
-                    self._tracks[row[FIELD_TRACK_ID]] = row
+                if not row:  # skip empty lines, as csv.DictReader does
+                    continue
+                duration = float(row[track_duration_column])
+                if duration >= 10:
+                    track = {FIELD_TRACK_ID: row[track_id_column],
+                             FIELD_TRACK_DURATION: duration,
+                             }
+                    if track_file_column is not None:
+                        track[FIELD_TRACK_FILE] = row[track_file_column]
+                    self._tracks[row[track_id_column]] = track
 
     def have_tracks(self):
         """
@@ -494,28 +554,36 @@ class QueryGenerator:
         self._init_difficulty(difficulty)
         random.seed(seed)
 
-        all_track_ids = sorted(self._tracks)
+        # the track IDs are sorted for the queries to be reproducible with the seed
+        if self._sorted_track_ids is None:
+            self._sorted_track_ids = sorted(self._tracks)
+        all_track_ids = self._sorted_track_ids
 
         if not num_queries:
             num_queries = 1 + int(0.15 * len(all_track_ids))
 
-        self._error_in_thread = None
-
+        futures = set()
         query_index = 0
         while num_queries > 0:
             # random number of query chunks in the query file
             num_chunks = min(3 + int(random.expovariate(0.5)), max(3, num_queries))
             num_queries -= num_chunks
 
-            # start choosing from all track IDs
-            track_ids = all_track_ids.copy()
+            # sorted indices of the tracks already used for this query
+            chosen_track_indices = []
 
             # generate chunks
             chunks = []
             for chunk_index in range(num_chunks):
-                # choose the track and remove it from the list to avoid using it for this query again
-                track_index = random.randrange(len(track_ids))
-                track_id = track_ids.pop(track_index)
+                # choose the track from the tracks not used for this query yet, the index into the remaining
+                # tracks is mapped to the index into all tracks by skipping the already chosen tracks
+                track_index = random.randrange(len(all_track_ids) - chunk_index)
+                for chosen_track_index in chosen_track_indices:
+                    if chosen_track_index > track_index:
+                        break
+                    track_index += 1
+                bisect.insort(chosen_track_indices, track_index)
+                track_id = all_track_ids[track_index]
                 track = self._tracks[track_id]
 
                 # get the random modification and noise (if any)
@@ -527,18 +595,17 @@ class QueryGenerator:
                 track_duration = track[FIELD_TRACK_DURATION]
                 if track_duration < 30:
                     # For short tracks, avoid using 2 seconds from the very beginning and end of the track.
-                    # Prefer longer durations by using sqrt(uniform(sqr(min), sqr(max))).
+                    margin = 2
                     max_duration = track_duration - 4 + 0.5
-                    chunk_duration = round(
-                        math.sqrt(random.uniform(math.ceil(4.5 * 4.5), math.floor(max_duration * max_duration))), 1)
-                    chunk_position = round(random.uniform(2, track_duration - chunk_duration - 2), 1)
                 else:
                     # For longer tracks, avoid using 6 seconds from the very beginning and end of the track.
-                    # Prefer longer durations by using sqrt(uniform(sqr(min), sqr(max))).
+                    margin = 6
                     max_duration = min(30, track_duration - 12) + 0.5
-                    chunk_duration = round(
-                        math.sqrt(random.uniform(math.ceil(4.5 * 4.5), math.floor(max_duration * max_duration))), 1)
-                    chunk_position = round(random.uniform(6, track_duration - chunk_duration - 6), 1)
+
+                # Prefer longer durations by using sqrt(uniform(sqr(min), sqr(max))).
+                chunk_duration = round(
+                    math.sqrt(random.uniform(MIN_CHUNK_DURATION_SQR, math.floor(max_duration * max_duration))), 1)
+                chunk_position = round(random.uniform(margin, track_duration - chunk_duration - margin), 1)
 
                 # add the chunk description to the list of chunks
                 chunk = {FIELD_CHUNK_INDEX: chunk_index,
@@ -552,21 +619,6 @@ class QueryGenerator:
                          }
                 chunks.append(chunk)
 
-                # create the chunk
-                if not dry_run:
-                    if self._queue:
-                        self._queue.put(functools.partial(self._create_chunk, chunk, codec, sample_rate, query_index))
-                    else:
-                        self._create_chunk(chunk, codec, sample_rate, query_index)
-
-            # wait until the background threads creating chunks finish
-            if self._queue:
-                self._queue.join()
-
-            # throw the Exception originating from the thread
-            if self._error_in_thread:
-                raise self._error_in_thread
-
             # concatenate parts
             for chunk_index in range(num_chunks - 1):
                 this_chunk = chunks[chunk_index]
@@ -587,19 +639,59 @@ class QueryGenerator:
 
             query_id = f'query{query_index:04d}'
             if not dry_run:
-                self._create_query(query_id, chunks, codec, sample_rate)
+                if self._executor:
+                    # keep at most two queries per thread in flight, and throw the Exception originating from
+                    # a thread as soon as possible
+                    if len(futures) >= 2 * self._num_threads:
+                        done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    futures.add(self._executor.submit(self._create_query, query_id, chunks, codec, sample_rate))
+                else:
+                    self._create_query(query_id, chunks, codec, sample_rate)
             self._add_query_annotations(query_id, chunks)
             query_index += 1
 
-    def write_annotations(self, annotation_file):
+        # wait until the background threads creating queries finish, and throw the Exception originating
+        # from a thread
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def open_annotations(self, annotation_file):
+        """
+        Open the annotation file for writing the annotations of the generated queries.
+
+        The annotations are written to a temporary file, which replaces the annotation file only when all
+        the queries are created successfully.
+        """
+        self._annotation_file = annotation_file
+        self._annotation_fw = open(annotation_file + '.tmp', 'w')
+        self._annotation_writer = csv.writer(self._annotation_fw, delimiter=',', lineterminator='\n')
+        self._annotation_writer.writerow(ANNOTATION_FIELDS)
+        self._last_query_id = None
+        self._annotations_sorted = True
+
+    def close_annotations(self, success=True):
         """
-        Write annotations to the annotation file.
+        Close the annotation file, and sort it if the annotations were not written in the sorted order.
+
+        Parameters:
+            success: whether all the queries were created, otherwise the annotations are discarded
         """
-        with open(annotation_file, 'w') as fw:
-            writer = csv.DictWriter(fw, ANNOTATION_FIELDS, delimiter=',', lineterminator='\n')
-            writer.writeheader()
-            for row in sorted(self._annotations, key=itemgetter(*ANNOTATION_SORT_FIELDS)):
-                writer.writerow(row)
+        if self._annotation_fw:
+            self._annotation_fw.close()
+            self._annotation_fw = None
+            self._annotation_writer = None
+
+            tmp_annotation_file = self._annotation_file + '.tmp'
+            if not success:
+                os.remove(tmp_annotation_file)
+                return
+
+            if not self._annotations_sorted:
+                sort_annotation_file(tmp_annotation_file)
+            os.replace(tmp_annotation_file, self._annotation_file)
 
 
 def main():
@@ -609,7 +701,7 @@ def main():
 
     initialize(args)
 
-    g = QueryGenerator(args.query_dir, args.tmp_dir, args.threads)
+    g = QueryGenerator(args.query_dir, args.threads)
 
     # load the tracks from the track lists
     for fn in args.track_list:
@@ -618,15 +710,16 @@ def main():
         print('No tracks were loaded', file=sys.stderr)
         sys.exit(1)
 
-    # generate queries
+    # generate queries, the annotations are kept only if all the queries were created
+    success = False
     try:
         g.create_threads()
+        g.open_annotations(args.annotation_file)
         g.generate_queries(args.difficulty, args.num_queries, args.seed, args.codec, args.sample_rate, args.dry_run)
-        g.write_annotations(args.annotation_file)
+        success = True
     finally:
         g.join_threads()
-
-    cleanup(args)
+        g.close_annotations(success)
 
 
 if __name__ == '__main__':
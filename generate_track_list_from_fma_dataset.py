@@ -12,10 +12,17 @@ from the FMA dataset.
 
 import argparse
 import csv
+import multiprocessing
 import os.path
 import sys
 
-from util import get_track_duration
+from util import get_track_durations
+
+
+# set of allowed licenses
+LICENSES = frozenset({'by-sa', 'by', 'cc-zero', 'publicdomain',
+                      'http://artlibre.org/licence/lal/en',
+                      'http://creativecommons.org/licenses/sampling+/1.0/'})
 
 
 def get_parser():
@@ -27,60 +34,142 @@ def get_parser():
     parser.add_argument('input', help='File name of input list (fma_metadata/raw_tracks.csv from FMA dataset)')
     parser.add_argument('output', help='File name for the output list')
     parser.add_argument('--fma-path', '-f', default='', help='Path to the FMA dataset track files')
+    parser.add_argument('--csv-engine', choices=['csv', 'pyarrow'], default='csv',
+                        help='CSV parser used for loading the input list, pyarrow is faster for large files')
+    parser.add_argument('--processes', '-p', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of parallel processes probing the track durations')
+    parser.add_argument('--duration-cache', help='SQLite file caching the track durations between runs')
 
     return parser
 
 
+def get_license(license_image_file, license_url):
+    """
+    Get the license of the FMA track.
+
+    Parameters:
+        license_image_file: URL of the license image
+        license_url: URL of the license
+
+    Returns:
+        base name of the license image without the extension, or the license URL
+    """
+    # os.path.splitext() keeps the leading dots of the name (e.g. '..png'), as the pyarrow engine does
+    lic = os.path.splitext(license_image_file.rpartition('/')[2])[0]
+    return lic or license_url
+
+
+def load_licensed_tracks(fn, engine='csv'):
+    """
+    Load the rows of the FMA track list with the allowed licenses.
+
+    Parameters:
+        fn: file name of the FMA track list
+        engine: CSV parser ('csv' for the Python csv module, or 'pyarrow')
+
+    Returns:
+        list of the rows (dicts mapping the column names to the values)
+    """
+    if engine == 'pyarrow':
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+
+        # the column types must be given explicitly, otherwise e.g. the license URLs could be parsed as nulls
+        with open(fn, 'rt') as fr:
+            header = next(csv.reader(fr, delimiter=','), None)
+        if header is None:
+            return []
+
+        parse_options = pyarrow.csv.ParseOptions(delimiter=',', newlines_in_values=True)
+        convert_options = pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in header})
+        with pyarrow.memory_map(fn) as source:
+            table = pyarrow.csv.read_csv(source, parse_options=parse_options, convert_options=convert_options)
+
+        # check the licenses of all the rows at once (the same way as get_license)
+        lic = pyarrow.compute.replace_substring_regex(table['license_image_file_large'], r'^.*/', '')
+        lic = pyarrow.compute.replace_substring_regex(lic, r'^(\.*[^.].*)\.[^.]*$', r'\1')
+        lic = pyarrow.compute.if_else(pyarrow.compute.equal(lic, ''), table['license_url'], lic)
+        mask = pyarrow.compute.is_in(lic, value_set=pyarrow.array(sorted(LICENSES)))
+        return table.filter(mask).to_pylist()
+
+    with open(fn, 'rt') as fr:
+        reader = csv.DictReader(fr, delimiter=',')
+        return [row for row in reader if get_license(row['license_image_file_large'], row['license_url']) in LICENSES]
+
+
+def get_existing_track_files(fma_path):
+    """
+    Get the set of the track files existing in the FMA dataset.
+
+    Parameters:
+        fma_path: path to the FMA dataset track files
+
+    Returns:
+        set of the track file names relative to fma_path (e.g. '000/000002.mp3')
+    """
+    track_files = set()
+    try:
+        with os.scandir(fma_path or os.curdir) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    track_files.update(f'{subdir.name}/{entry.name}' for entry in entries)
+    except OSError:
+        # e.g. a wrong path, no tracks exist then
+        return set()
+    return track_files
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
 
-    # set of allowed licenses
-    licenses = {'by-sa', 'by', 'cc-zero', 'publicdomain',
-                'http://artlibre.org/licence/lal/en',
-                'http://creativecommons.org/licenses/sampling+/1.0/'}
+    # list the track files at once, instead of checking the existence of each track file
+    existing_track_files = get_existing_track_files(args.fma_path)
 
-    output_data = []
+    candidates = []
 
-    # read the input file with the FMA track list
-    with open(args.input, 'rt') as fr:
-        reader = csv.DictReader(fr, delimiter=',')
-        for row in reader:
-            # check the license
-            lic = os.path.splitext(os.path.basename(row['license_image_file_large']))[0]
-            if not lic:
-                lic = row['license_url']
-            if lic not in licenses:
-                continue
+    # read the input file with the FMA track list, keeping only the tracks with the allowed licenses
+    for row in load_licensed_tracks(args.input, args.csv_engine):
+        # check that the track file exists
+        track_id = int(row['track_id'])
+        if f'{track_id//1000:03}/{track_id:06}.mp3' not in existing_track_files:
+            continue
+        track_file = os.path.join(args.fma_path, f'{track_id//1000:03}', f'{track_id:06}.mp3')
+        row['track_file'] = track_file
+        row['track_id'] = f'{track_id:06}'
 
-            # check that the track file exists
-            track_id = int(row['track_id'])
-            track_file = os.path.join(args.fma_path, f'{track_id//1000:03}', f'{track_id:06}.mp3')
-            if not os.path.exists(track_file):
-                continue
-            row['track_file'] = track_file
-            row['track_id'] = f'{track_id:06}'
+        candidates.append(row)
+
+    # find out the durations of the media files, because track_duration can't be trusted
+    track_files = [row['track_file'] for row in candidates]
+    track_durations = get_track_durations(track_files, args.processes, args.duration_cache)
 
-            # find out the duration of the media file, because track_duration can't be trusted
-            track_duration = get_track_duration(track_file)
+    def get_output_rows():
+        for row, track_duration in zip(candidates, track_durations):
             if not track_duration:
                 continue
             if track_duration < 10:
                 continue
             row['track_duration'] = track_duration
+            yield row
 
-            output_data.append(row)
-
-    # write the output file
-    if output_data:
-        with open(args.output, 'wt') as fw:
-            writer = csv.DictWriter(fw, output_data[0].keys(), delimiter=',', lineterminator='\n')
-            writer.writeheader()
-            for row in output_data:
-                writer.writerow(row)
-    else:
+    # the first suitable row gives the output fields
+    output_rows = get_output_rows()
+    first_row = next(output_rows, None)
+    if first_row is None:
         print('No suitable input tracks exist!', file=sys.stderr)
         sys.exit(1)
+    output_fields = list(first_row.keys())
+
+    # write the output file, as the durations become available
+    with open(args.output, 'wt') as fw:
+        writer = csv.writer(fw, delimiter=',', lineterminator='\n')
+        writer.writerow(output_fields)
+        writer.writerow([first_row[field] for field in output_fields])
+        writer.writerows([row[field] for field in output_fields] for row in output_rows)
 
 
 if __name__ == '__main__':
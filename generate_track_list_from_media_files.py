@@ -11,9 +11,11 @@ Script preparing the reference track list from the given set of media files.
 
 import argparse
 import csv
+import multiprocessing
 import sys
 
-from util import get_track_duration, get_track_id_from_file_name
+from symlink_reference_audios import load_references_from_annotations
+from util import get_track_durations, get_track_id_from_file_name
 
 
 def get_parser():
@@ -25,6 +27,11 @@ def get_parser():
     parser.add_argument('track', nargs='*', help='Track file name(s)')
     parser.add_argument('--input', '-i', help='File name with the input list of media files')
     parser.add_argument('--output', '-o', required=True, help='File name for the output CSV')
+    parser.add_argument('--annotation-file', '-a',
+                        help='Annotation file, only the tracks used as references in it are listed')
+    parser.add_argument('--processes', '-p', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of parallel processes probing the track durations')
+    parser.add_argument('--duration-cache', help='SQLite file caching the track durations between runs')
 
     return parser
 
@@ -48,27 +55,26 @@ def main():
                 track_file = line.rstrip()
                 args.track.append(track_file)
 
+    # keep only the tracks used by the queries, so that the other tracks are not probed
+    if args.annotation_file:
+        references = load_references_from_annotations(args.annotation_file)
+        args.track = [track_file for track_file in args.track if get_track_id_from_file_name(track_file) in references]
+
     # prepare the track list, including durations
-    for track_file in args.track:
-        duration = get_track_duration(track_file)
+    durations = get_track_durations(args.track, args.processes, args.duration_cache)
+    for track_file, duration in zip(args.track, durations):
         if not duration:
             continue
 
         track_id = get_track_id_from_file_name(track_file)
-        tracks[track_id] = {
-            'track_id': track_id,
-            'track_file': track_file,
-            'track_duration': duration,
-            }
+        tracks[track_id] = (track_id, track_file, duration)
 
     # write the track list
     with open(args.output, 'w') as fw:
         output_fields = ['track_id', 'track_file', 'track_duration']
-        writer = csv.DictWriter(fw, output_fields, lineterminator='\n')
-        writer.writeheader()
-        for track_id in sorted(tracks):
-            row = tracks[track_id]
-            writer.writerow(row)
+        writer = csv.writer(fw, lineterminator='\n')
+        writer.writerow(output_fields)
+        writer.writerows(tracks[track_id] for track_id in sorted(tracks))
 
 
 if __name__ == '__main__':
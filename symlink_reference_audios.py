@@ -11,8 +11,10 @@ audio files, for creating a package with all needed files.
 """
 
 import argparse
+import concurrent.futures
 import csv
 import os
+import sys
 
 from fields import *
 
@@ -28,24 +30,55 @@ def get_parser():
                         help='Output file with annotations for generated queries')
     parser.add_argument('--reference-dir', '-r', default='references',
                         help='Directory for symlinked reference audios')
+    parser.add_argument('--csv-engine', choices=['csv', 'pyarrow'], default='csv',
+                        help='CSV parser used for loading the track lists, pyarrow is faster for large files')
+    parser.add_argument('--threads', '-T', type=int, default=32,
+                        help='Number of threads creating the symlinks')
 
     return parser
 
 
-def load_track_list(track_lists):
+def load_track_list(track_lists, engine='csv'):
     """
     Load track list from the file(s).
 
+    Only the track ID and track file columns are read.
+
+    Parameters:
+        track_lists: file names of the track lists
+        engine: CSV parser ('csv' for the Python csv module, or 'pyarrow')
+
     Returns:
         dict of tracks mapping track ID to track file
     """
     tracks = dict()
 
+    if engine == 'pyarrow':
+        import pyarrow
+        import pyarrow.csv
+
+        # the track IDs must be read as strings, otherwise e.g. the leading zeros would be lost
+        columns = [FIELD_TRACK_ID, FIELD_TRACK_FILE]
+        parse_options = pyarrow.csv.ParseOptions(newlines_in_values=True)
+        convert_options = pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in columns},
+                                                     include_columns=columns)
+        for fn in track_lists:
+            table = pyarrow.csv.read_csv(fn, parse_options=parse_options, convert_options=convert_options)
+            tracks.update(zip(table[FIELD_TRACK_ID].to_pylist(), table[FIELD_TRACK_FILE].to_pylist()))
+
+        return tracks
+
     for fn in track_lists:
         with open(fn, 'r') as fr:
-            reader = csv.DictReader(fr)
+            reader = csv.reader(fr)
+            header = next(reader, None)
+            if header is None:
+                continue
+            track_id_index = header.index(FIELD_TRACK_ID)
+            track_file_index = header.index(FIELD_TRACK_FILE)
             for row in reader:
-                tracks[row[FIELD_TRACK_ID]] = row[FIELD_TRACK_FILE]
+                if row:  # skip empty lines, as csv.DictReader does
+                    tracks[row[track_id_index]] = row[track_file_index]
 
     return tracks
 
@@ -64,10 +97,20 @@ def load_references_from_annotations(fn):
     return references
 
 
-def symlink_reference_audios(references, tracks, reference_dir):
+def symlink_reference_audios(references, tracks, reference_dir, num_threads=1):
     """
     Symlink track files of the references to the reference dir.
     """
+    # check all the references at once, before any symlink is created
+    missing_references = set(references).difference(tracks)
+    if missing_references:
+        print(f'{len(missing_references)} reference(s) missing in the track list(s), skipped:', file=sys.stderr)
+        for reference in sorted(missing_references):
+            print(f'  {reference}', file=sys.stderr)
+        references = set(references).difference(missing_references)
+
+    # the references are grouped by the target dir, which is created only once
+    links = []
     for reference in references:
         track_file = tracks[reference]
         file_name = os.path.basename(track_file)
@@ -81,13 +124,40 @@ def symlink_reference_audios(references, tracks, reference_dir):
         else:
             target_dir = reference_dir
 
+        links.append((target_dir, file_name, track_file))
+    links.sort()
+
+    sources = []
+    created_dirs = set()
+    for target_dir, file_name, track_file in links:
         if os.path.isabs(track_file):
-            source_fn = track_file
+            sources.append(track_file)
+        else:
+            sources.append(os.path.relpath(track_file, target_dir))
+
+        if target_dir not in created_dirs:
+            os.makedirs(target_dir, exist_ok=True)
+            created_dirs.add(target_dir)
+
+    dir_fds = dict()
+    try:
+        if os.symlink in os.supports_dir_fd:
+            # the links are created relative to the opened target dirs, so the target dir paths are resolved only once
+            for target_dir in created_dirs:
+                dir_fds[target_dir] = os.open(target_dir, os.O_RDONLY | os.O_DIRECTORY)
+            link_fns = [file_name for _, file_name, _ in links]
         else:
-            source_fn = os.path.relpath(track_file, target_dir)
+            link_fns = [os.path.join(target_dir, file_name) for target_dir, file_name, _ in links]
+        link_dir_fds = [dir_fds.get(target_dir) for target_dir, _, _ in links]
 
-        os.makedirs(target_dir, exist_ok=True)
-        os.symlink(source_fn, os.path.join(target_dir, file_name))
+        # the symlinks are created in parallel to overlap the latencies of the file system
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for _ in executor.map(lambda source, link_fn, dir_fd: os.symlink(source, link_fn, dir_fd=dir_fd),
+                                  sources, link_fns, link_dir_fds):
+                pass
+    finally:
+        for dir_fd in dir_fds.values():
+            os.close(dir_fd)
 
 
 def main():
@@ -95,9 +165,9 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
 
-    tracks = load_track_list(args.track_list)
+    tracks = load_track_list(args.track_list, args.csv_engine)
     references = load_references_from_annotations(args.annotation_file)
-    symlink_reference_audios(references, tracks, args.reference_dir)
+    symlink_reference_audios(references, tracks, args.reference_dir, args.threads)
 
 
 if __name__ == '__main__':
@@ -9,17 +9,62 @@
 Utility functions for the Audio Fingerprinting Benchmark Toolkit.
 """
 
+import concurrent.futures
 import math
+import numpy as np
 import os.path
+import re
+import sqlite3
 import subprocess
 import sys
 
+try:
+    # optional dependency, for reading the media files without running ffprobe
+    import av
+except ImportError:
+    av = None
+
 
 def get_track_duration(fn):
     """
     Get the duration in seconds of the given media file.
     """
 
+    if av is not None:
+        return _get_track_duration_av(fn)
+    return _get_track_duration_ffprobe(fn)
+
+
+def _get_track_duration_av(fn):
+    """
+    Get the duration in seconds of the given media file, reading it with PyAV.
+    """
+
+    # The duration of the container/stream is not reliable for media files with Variable Bit Rate,
+    # so we are demuxing the audio packets and reading the timestamp and duration of the last one
+    # (the same way as with ffprobe, but without running a process per file).
+    try:
+        with av.open(fn, metadata_errors='ignore') as container:
+            if not container.streams.audio:
+                raise ValueError('no audio stream')
+            last_packet_end = None
+            for packet in container.demux(container.streams.audio):
+                if packet.pts is None or packet.duration is None:
+                    continue  # flushing packet
+                last_packet_end = (packet.pts + packet.duration) * packet.time_base
+            if last_packet_end is None:
+                raise ValueError('no audio packets')
+            return round(float(last_packet_end), 3)
+    except (av.FFmpegError, ValueError) as e:
+        print(f'{fn}: reading the media file failed! {e}', file=sys.stderr)
+        return None
+
+
+def _get_track_duration_ffprobe(fn):
+    """
+    Get the duration in seconds of the given media file, using ffprobe.
+    """
+
     # Simple "ffprobe -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 $fn" does not work well
     # for media files with Variable Bit Rate.
     # So we are reading the timestamp and duration of the last packet.
@@ -32,9 +77,9 @@ def get_track_duration(fn):
         print('STDERR:\n', p.stderr.decode(), file=sys.stderr)
         return None
 
-    # Decode the output, and calculate the stream duration
+    # Parse the output (float() accepts bytes), and calculate the stream duration
     try:
-        lines = p.stdout.decode().splitlines()[-2:]  # PTS and duration of the last packet (in seconds)
+        lines = p.stdout.rstrip().rsplit(b'\n', 2)[-2:]  # PTS and duration of the last packet (in seconds)
         return round(float(lines[0]) + float(lines[1]), 3)
     except BaseException:
         print(f'{fn}: invalid output of ffprobe!', file=sys.stderr)
@@ -42,30 +87,121 @@ def get_track_duration(fn):
         return None
 
 
+def get_track_durations(fns, num_processes=None, cache_file=None):
+    """
+    Get the durations in seconds of the given media files, probing them in parallel.
+
+    Parameters:
+        fns: list of file names
+        num_processes: number of parallel processes probing the files (default: number of CPUs)
+        cache_file: optional SQLite file caching the durations between runs
+
+    Yields:
+        durations in the order of the files (None for the files that could not be probed)
+    """
+
+    if not cache_file:
+        yield from _probe_track_durations(fns, num_processes)
+        return
+
+    # the cached durations are valid as long as the file is not modified (or replaced)
+    keys = []
+    for fn in fns:
+        try:
+            st = os.stat(fn)
+            keys.append(f'{os.path.abspath(fn)}:{st.st_mtime_ns}:{st.st_size}')
+        except OSError:
+            keys.append(None)  # probed anyway, to report the error
+
+    db = sqlite3.connect(cache_file)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS durations (key TEXT PRIMARY KEY, duration REAL)')
+        cached = dict()
+        for i in range(0, len(keys), 500):
+            batch = [key for key in keys[i:i + 500] if key is not None]
+            query = f'SELECT key, duration FROM durations WHERE key IN ({", ".join("?" * len(batch))})'
+            cached.update(db.execute(query, batch))
+
+        # probe only the files missing in the cache, the results are merged in the order of the files
+        probed = _probe_track_durations([fn for fn, key in zip(fns, keys) if key not in cached], num_processes)
+        for key in keys:
+            if key in cached:
+                yield cached[key]
+                continue
+
+            duration = next(probed)
+            if duration is not None and key is not None:
+                db.execute('INSERT OR REPLACE INTO durations (key, duration) VALUES (?, ?)', (key, duration))
+            yield duration
+    finally:
+        db.commit()
+        db.close()
+
+
+def _probe_track_durations(fns, num_processes=None):
+    """
+    Get the durations in seconds of the given media files, probing them in parallel.
+    """
+
+    if av is None:
+        # the probing is done by the ffprobe processes, so threads are enough to run them in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_processes) as executor:
+            yield from executor.map(get_track_duration, fns)
+    else:
+        # PyAV demuxes the files in the Python process, so the probing is spread over the worker processes
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+            yield from executor.map(get_track_duration, fns, chunksize=32)
+
+
+# known extensions (audio, video, data), possibly chained, after a file name not consisting only of dots
+_TRACK_ID_FILE_NAME_RE = re.compile(r'(\.*[^.].*?)(?:\.(?:aac|flac|m4a|mp3|ogg|opus|vorbis|wav|wma'
+                                    r'|avi|flv|mkv|mov|mp4|mpg|wmv'
+                                    r'|csv|json|msgpack|txt))+', re.DOTALL)
+
+
 def get_track_id_from_file_name(fn):
     """
     Get the track ID (the base file name without known extensions) from the file name.
     """
-    known_exts = {'.aac', '.flac', '.m4a', '.mp3', '.ogg', '.opus', '.vorbis', '.wav', '.wma',  # audio
-                  '.avi', '.flv', '.mkv', '.mov', '.mp4', '.mpg', '.wmv',  # video
-                  '.csv', '.json', '.msgpack', '.txt'}  # data
-
     track_id = os.path.basename(fn)
-    while True:
-        root, ext = os.path.splitext(track_id)
-        if ext in known_exts:
-            track_id = root
-        else:
-            break
+    match = _TRACK_ID_FILE_NAME_RE.fullmatch(track_id)
+    if match:
+        track_id = match.group(1)
 
     return track_id
 
 
+def union_lengths(los, his, mask):
+    """
+    Get the lengths of the unions of the half-open intervals [lo, hi) in each row of the 2D arrays,
+    using only the intervals selected by the mask.
+
+    The intervals in each row are sorted by their beginnings, then every interval adds its part
+    above the maximum end of all preceding intervals.
+    """
+    num_rows, num_cols = los.shape
+    if not num_cols:
+        return np.zeros(num_rows, dtype=np.int64)
+
+    # intervals not selected by the mask become empty
+    his = np.where(mask, his, los)
+
+    order = np.argsort(los, axis=1, kind='stable')
+    los = np.take_along_axis(los, order, axis=1)
+    his = np.take_along_axis(his, order, axis=1)
+
+    preceding_his = np.empty_like(his)
+    preceding_his[:, 0] = np.iinfo(np.int64).min
+    np.maximum.accumulate(his[:, :-1], axis=1, out=preceding_his[:, 1:])
+
+    return np.clip(his - np.maximum(los, preceding_his), 0, None).sum(axis=1)
+
+
 def pitch_scale_to_cents(scale):
     """
     Convert pitch scale to cents (100 cents = 1 semitone, 12 semitones = 1 octave).
     """
-    return 1200 * math.log(scale) / math.log(2)
+    return 1200 * math.log2(scale)
 
 
 def tempo_scale_to_per_cent(scale):